@@ -1,41 +1,1856 @@
+import argparse
+import atexit
+import csv
+import hashlib
+import json
+import multiprocessing
 import os
 import random
 import sys
+import threading
+import time
+import numpy as np
 import vtk
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, QPushButton, QListWidget, QListWidgetItem, 
-                             QWidget, QCheckBox, QDialog, QSlider, QFormLayout, QLabel, QGroupBox)
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QFont
+                             QWidget, QCheckBox, QDialog, QSlider, QFormLayout, QLabel, QGroupBox, QProgressBar,
+                             QComboBox, QSpinBox, QFileDialog, QLineEdit)
+from PyQt5.QtCore import Qt, QObject, QTimer, pyqtSignal
+from PyQt5.QtGui import QFont, QImage, QPixmap
 from vtkmodules.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
+from vtkmodules.util import numpy_support
 import math
 
 
+# Minimum time between two renders of the scene (about one display frame)
+FRAME_INTERVAL_MS = 16
+
+# Minimum time between two writes of the metadata index, changes in between are written together
+INDEX_SAVE_INTERVAL_S = 2.0
+
+# Directory holding the on-disk caches (metadata index, meshes, ...)
+CACHE_DIR = os.environ.get(
+    "VISU_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "visu_project")
+)
 
-def load_nifti_as_actor(filename, threshold, color, label):
-    """Load a NIFTI file and create a VTK actor with contours."""
 
+def matrix_to_list(matrix):
+    """Flatten a vtkMatrix4x4 into a list of 16 values (None if there is no matrix)."""
+    if matrix is None:
+        return None
+    return [matrix.GetElement(i // 4, i % 4) for i in range(16)]
+
+
+def read_nifti_header(filename):
+    """Read the header of a NIFTI file without decompressing the voxel data."""
     reader = vtk.vtkNIFTIImageReader()
     reader.SetFileName(filename)
-    reader.Update()
+    reader.UpdateInformation()
+
+    info = reader.GetOutputInformation(0)
+    extent = info.Get(vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT())
+    spacing = info.Get(vtk.vtkDataObject.SPACING())
+    origin = info.Get(vtk.vtkDataObject.ORIGIN())
+
+    # Same bounds as vtkImageData.GetBounds() once the data is loaded
+    bounds = []
+    for axis in range(3):
+        first = origin[axis] + extent[2 * axis] * spacing[axis]
+        last = origin[axis] + extent[2 * axis + 1] * spacing[axis]
+        bounds.extend([min(first, last), max(first, last)])
+
+    header = reader.GetNIFTIHeader()
+    return {
+        "dims": [extent[2 * axis + 1] - extent[2 * axis] + 1 for axis in range(3)],
+        "extent": list(extent),
+        "spacing": list(spacing),
+        "origin": list(origin),
+        "bounds": bounds,
+        "datatype": header.GetDataType(),
+        "qform": matrix_to_list(reader.GetQFormMatrix()),
+        "sform": matrix_to_list(reader.GetSFormMatrix()),
+    }
+
+
+class NiftiMetadataIndex:
+    """Header metadata of NIFTI files, cached in memory and on disk by path, mtime and size."""
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.entries = {}
+        # The index is shared by the loader threads
+        self.lock = threading.RLock()
+        # Changes not written yet, and when the index was last written
+        self.dirty = False
+        self.last_save = 0.0
+        self.load()
+
+    def load(self):
+        """Load the on-disk index, starting empty if it is missing or unreadable."""
+        try:
+            with open(self.cache_path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        """Write the index to disk (atomically, so a crash never leaves a corrupt file)."""
+        with self.lock:
+            try:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                tmp_path = self.cache_path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(self.entries, f)
+                os.replace(tmp_path, self.cache_path)
+            except OSError as e:
+                print(f"Could not save metadata index: {e}")
+            self.dirty = False
+            self.last_save = time.monotonic()
+
+    def mark_changed(self):
+        """Record a change, written now if the last write is old enough and otherwise by a later one or flush()."""
+        with self.lock:
+            self.dirty = True
+            if time.monotonic() - self.last_save >= INDEX_SAVE_INTERVAL_S:
+                self.save()
+
+    def flush(self):
+        """Write the changes not written yet."""
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+    def get(self, filename):
+        """Return the metadata of a file, reading its header only if it changed on disk."""
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+                entry = read_nifti_header(path)
+                entry["mtime"] = stat.st_mtime
+                entry["size"] = stat.st_size
+                self.entries[path] = entry
+                self.mark_changed()
+            return entry
+
+    def get_hash(self, filename):
+        """Return the SHA-1 of the file content, hashed once per file version."""
+        entry = self.get(filename)
+        if "sha1" not in entry:
+            sha1 = hashlib.sha1()
+            with open(filename, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    sha1.update(chunk)
+            with self.lock:
+                entry["sha1"] = sha1.hexdigest()
+                self.mark_changed()
+        return entry["sha1"]
+
+    def get_bounds(self, filename):
+        """Return the world bounds (xmin, xmax, ymin, ymax, zmin, zmax) of a file."""
+        return tuple(self.get(filename)["bounds"])
+
+    def get_center(self, filename):
+        """Return the center of the bounding box of a file."""
+        bounds = self.get_bounds(filename)
+        return (
+            (bounds[0] + bounds[1]) / 2,
+            (bounds[2] + bounds[3]) / 2,
+            (bounds[4] + bounds[5]) / 2,
+        )
+
+
+# Shared metadata index used by all windows
+nifti_metadata = NiftiMetadataIndex(os.path.join(CACHE_DIR, "nifti_metadata.json"))
+atexit.register(nifti_metadata.flush)
+
+
+def structure_name(filename):
+    """Return the structure name of a NIFTI file (its name without the .nii.gz extension)."""
+    name = os.path.basename(filename)
+    for extension in (".nii.gz", ".nii"):
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def count_foreground_voxels(filename, threshold=0.5):
+    """Return the number of voxels of a mask above the threshold.
+
+    Counting a whole cohort reads every mask once, so it goes around the volume cache and the metadata index.
+    """
+    image_data = read_nifti_file(filename)
+    return int(np.count_nonzero(numpy_support.vtk_to_numpy(image_data.GetPointData().GetScalars()) > threshold))
+
+
+class CohortManifest:
+    """Persistent index of the NIFTI structures under a root folder, one entry per patient and structure.
+
+    The root holds either the .nii.gz files of a single patient or one sub-folder per patient. Each
+    entry records the patient, structure, dims, spacing, bounds, size, mtime and voxel count of a file.
+    The manifest is read instantly and refreshed incrementally: only new or changed files are rescanned.
+    """
+
+    def __init__(self, root, manifest_path=None):
+        self.root = os.path.abspath(root)
+        root_key = hashlib.sha1(self.root.encode()).hexdigest()
+        self.manifest_path = manifest_path or os.path.join(CACHE_DIR, "manifests", root_key + ".json")
+        self.entries = {}
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        """Load the on-disk manifest, starting empty if it is missing, unreadable or for another root."""
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            self.entries = manifest["files"] if manifest.get("root") == self.root else {}
+        except (OSError, ValueError, KeyError):
+            self.entries = {}
+
+    def save(self):
+        """Write the manifest to disk (atomically, so a crash never leaves a corrupt file)."""
+        with self.lock:
+            try:
+                os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+                tmp_path = self.manifest_path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump({"root": self.root, "files": self.entries}, f)
+                os.replace(tmp_path, self.manifest_path)
+            except OSError as e:
+                print(f"Could not save cohort manifest: {e}")
+
+    def scan(self):
+        """List the .nii.gz files under the root with their stat, as {path: (patient, stat)}."""
+        found = {}
+        root_patient = os.path.basename(self.root)
+        with os.scandir(self.root) as root_entries:
+            for entry in root_entries:
+                if entry.is_file() and entry.name.endswith(".nii.gz"):
+                    found[entry.path] = (root_patient, entry.stat())
+                elif entry.is_dir():
+                    with os.scandir(entry.path) as patient_entries:
+                        for file_entry in patient_entries:
+                            if file_entry.is_file() and file_entry.name.endswith(".nii.gz"):
+                                found[file_entry.path] = (entry.name, file_entry.stat())
+        return found
+
+    def refresh(self, is_cancelled=None, max_workers=None):
+        """Bring the entries up to date with the files on disk, reading only the new or changed headers.
+
+        Voxel counts of the rescanned files are left to count_voxels(). Returns whether anything changed.
+        """
+        found = self.scan()
+        with self.lock:
+            removed = [path for path in self.entries if path not in found]
+            for path in removed:
+                del self.entries[path]
+            changed = [
+                path for path, (_, stat) in found.items()
+                if path not in self.entries
+                or self.entries[path]["mtime"] != stat.st_mtime or self.entries[path]["size"] != stat.st_size
+            ]
+
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+            futures = {executor.submit(read_nifti_header, path): path for path in changed}
+            for future in as_completed(futures):
+                if is_cancelled is not None and is_cancelled():
+                    # Leaving the executor would otherwise wait for the queued reads
+                    for pending in futures:
+                        pending.cancel()
+                    break
+                path = futures[future]
+                patient, stat = found[path]
+                try:
+                    header = future.result()
+                except Exception as e:
+                    print(f"Could not read {path}: {e}")
+                    continue
+                with self.lock:
+                    self.entries[path] = {
+                        "patient": patient,
+                        "structure": structure_name(path),
+                        "dims": header["dims"],
+                        "spacing": header["spacing"],
+                        "bounds": header["bounds"],
+                        "size": stat.st_size,
+                        "mtime": stat.st_mtime,
+                        "voxel_count": None,
+                    }
+
+        if removed or changed:
+            self.save()
+        return bool(removed or changed)
+
+    def count_voxels(self, is_cancelled=None, max_workers=None):
+        """Fill in the missing voxel counts, reading the masks in parallel. Returns whether any was added."""
+        with self.lock:
+            missing = [path for path, entry in self.entries.items() if entry["voxel_count"] is None]
+        counted = 0
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+            futures = {executor.submit(count_foreground_voxels, path): path for path in missing}
+            for future in as_completed(futures):
+                if is_cancelled is not None and is_cancelled():
+                    for pending in futures:
+                        pending.cancel()
+                    break
+                try:
+                    voxel_count = future.result()
+                except Exception as e:
+                    print(f"Could not read {futures[future]}: {e}")
+                    continue
+                with self.lock:
+                    if futures[future] in self.entries:
+                        self.entries[futures[future]]["voxel_count"] = voxel_count
+                        counted += 1
+                # Counting a large cohort takes a while, keep the progress if the app is closed
+                if counted % 100 == 0:
+                    self.save()
+
+        if counted:
+            self.save()
+        return counted > 0
+
+    def files(self, patient_filter="", structure_filter=""):
+        """Return the indexed files sorted by patient and structure, optionally filtered by substrings."""
+        patient_filter = patient_filter.lower()
+        structure_filter = structure_filter.lower()
+        with self.lock:
+            items = sorted(self.entries.items(), key=lambda item: (item[1]["patient"], item[1]["structure"]))
+        return [
+            path for path, entry in items
+            if patient_filter in entry["patient"].lower() and structure_filter in entry["structure"].lower()
+        ]
+
+    def patients(self):
+        """Return the sorted patient names."""
+        with self.lock:
+            return sorted({entry["patient"] for entry in self.entries.values()})
 
-    contour = vtk.vtkMarchingCubes()
-    contour.SetInputConnection(reader.GetOutputPort())
+    def get(self, filename):
+        """Return the entry of a file (None if it is not indexed)."""
+        with self.lock:
+            return self.entries.get(os.path.abspath(filename))
+
+
+class MeshCache:
+    """Content-addressed on-disk cache of surface meshes, capped in size with LRU eviction."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def make_key(self, filename, threshold, settings):
+        """Build the cache key from the file content, the threshold and the extraction settings."""
+        description = json.dumps(
+            [nifti_metadata.get_hash(filename), threshold, settings], sort_keys=True
+        )
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def path_for(self, key):
+        """Return the path of the cache entry for a key."""
+        return os.path.join(self.directory, key + ".vtp")
+
+    def load(self, key):
+        """Return the cached polydata for a key, or None on a miss."""
+        path = self.path_for(key)
+        if not os.path.exists(path):
+            return None
+
+        reader = vtk.vtkXMLPolyDataReader()
+        reader.SetFileName(path)
+        reader.Update()
+        if reader.GetErrorCode():
+            return None
+
+        # Touch the entry so that it is the most recently used one
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return reader.GetOutput()
+
+    def store(self, key, poly_data):
+        """Write polydata to the cache as raw binary VTP, then enforce the size cap."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError as e:
+            print(f"Could not create mesh cache: {e}")
+            return
+
+        path = self.path_for(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        # Appended raw data without compression is the fastest layout to read back
+        writer = vtk.vtkXMLPolyDataWriter()
+        writer.SetFileName(tmp_path)
+        writer.SetInputData(poly_data)
+        writer.SetDataModeToAppended()
+        writer.EncodeAppendedDataOff()
+        writer.SetCompressorTypeToNone()
+        if not writer.Write():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in its size cap."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".vtp"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Already evicted by another loader thread
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+# Shared mesh cache, its size cap can be changed with VISU_MESH_CACHE_MB
+mesh_cache = MeshCache(
+    os.path.join(CACHE_DIR, "meshes"),
+    int(os.environ.get("VISU_MESH_CACHE_MB", "2048")) * 1024 * 1024,
+)
+
+class VolumeCache:
+    """Content-addressed on-disk cache of decompressed NIFTI volumes, read back through memory mapping.
+
+    Each entry is a raw voxel file (C order, [k, j, i], starting at offset 0 so it maps page-aligned)
+    plus a JSON file with what is needed to rebuild the vtkImageData. The cache is capped in size with
+    LRU eviction. A cap of 0 disables it.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def paths_for(self, key):
+        """Return the (raw data, metadata) paths of the cache entry for a key."""
+        base = os.path.join(self.directory, key)
+        return base + ".raw", base + ".json"
+
+    def load(self, key):
+        """Return the cached image for a key wrapping the mapped file without copy, or None on a miss."""
+        raw_path, meta_path = self.paths_for(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            dims = meta["dims"]
+            shape = (dims[2], dims[1], dims[0], meta["components"])
+            # Copy-on-write mapping: pages are shared with other readers until written to
+            voxels = np.memmap(raw_path, dtype=np.dtype(meta["dtype"]), mode="c", shape=shape)
+        except (OSError, ValueError, KeyError):
+            return None
+
+        # Touch the entry so that it is the most recently used one
+        try:
+            os.utime(raw_path)
+        except OSError:
+            pass
+
+        # The VTK array keeps a reference to the mapping, which stays open as long as the image
+        scalars = numpy_support.numpy_to_vtk(voxels.reshape(-1, meta["components"]), deep=False)
+        image_data = vtk.vtkImageData()
+        image_data.SetExtent(meta["extent"])
+        image_data.SetSpacing(meta["spacing"])
+        image_data.SetOrigin(meta["origin"])
+        image_data.GetPointData().SetScalars(scalars)
+        return image_data
+
+    def store(self, key, image_data):
+        """Write the voxels and metadata of an image to the cache, then enforce the size cap."""
+        if self.max_bytes <= 0:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError as e:
+            print(f"Could not create volume cache: {e}")
+            return
+
+        raw_path, meta_path = self.paths_for(key)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        scalars = numpy_support.vtk_to_numpy(image_data.GetPointData().GetScalars())
+        meta = {
+            "dims": list(image_data.GetDimensions()),
+            "extent": list(image_data.GetExtent()),
+            "spacing": list(image_data.GetSpacing()),
+            "origin": list(image_data.GetOrigin()),
+            "dtype": scalars.dtype.str,
+            "components": image_data.GetPointData().GetScalars().GetNumberOfComponents(),
+        }
+        try:
+            scalars.tofile(raw_path + suffix)
+            with open(meta_path + suffix, "w") as f:
+                json.dump(meta, f)
+            # The metadata is moved last, an entry is only visible once its data is complete
+            os.replace(raw_path + suffix, raw_path)
+            os.replace(meta_path + suffix, meta_path)
+        except OSError as e:
+            print(f"Could not write volume cache entry: {e}")
+            for path in (raw_path + suffix, meta_path + suffix):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in its size cap."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".raw"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Already evicted by another loader thread
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                # Metadata first, so the entry disappears before its data does
+                os.remove(path[:-len(".raw")] + ".json")
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+# Shared volume cache, its size cap can be changed with VISU_VOLUME_CACHE_MB (0 disables it)
+volume_cache = VolumeCache(
+    os.path.join(CACHE_DIR, "volumes"),
+    int(os.environ.get("VISU_VOLUME_CACHE_MB", "16384")) * 1024 * 1024,
+)
+
+# Available surface extraction engines, flying edges is multithreaded through vtkSMPTools
+SURFACE_ENGINES = ("flying_edges", "marching_cubes")
+
+# Settings that change the extracted surface, part of the mesh cache key
+SURFACE_SETTINGS = {"engine": "flying_edges", "normals": True, "crop_pad": 1}
+
+
+def configure_surface_extraction(engine=None, smp_backend=None, smp_threads=None):
+    """Select the surface extraction engine and set up the VTK SMP backend.
+
+    Unset values come from VISU_SURFACE_ENGINE, VISU_SMP_BACKEND and VISU_SMP_THREADS
+    (0 threads means one per core).
+    """
+    engine = engine or os.environ.get("VISU_SURFACE_ENGINE", "flying_edges")
+    if engine not in SURFACE_ENGINES:
+        raise ValueError(f"Unknown surface engine {engine!r}, expected one of {SURFACE_ENGINES}")
+    SURFACE_SETTINGS["engine"] = engine
+
+    smp_backend = smp_backend or os.environ.get("VISU_SMP_BACKEND", "STDThread")
+    if smp_threads is None:
+        smp_threads = int(os.environ.get("VISU_SMP_THREADS", "0"))
+    if not vtk.vtkSMPTools.SetBackend(smp_backend):
+        print(f"SMP backend {smp_backend} is not available")
+    vtk.vtkSMPTools.Initialize(smp_threads)
+
+    print(
+        f"Surface engine: {engine} (SMP backend {vtk.vtkSMPTools.GetBackend()}, "
+        f"{vtk.vtkSMPTools.GetEstimatedNumberOfThreads()} threads)"
+    )
+
+
+def read_nifti_file(filename):
+    """Read and decompress a NIFTI file, without the volume cache."""
+    reader = vtk.vtkNIFTIImageReader()
+    reader.SetFileName(filename)
+    reader.Update()
+    return reader.GetOutput()
+
+
+def read_nifti_image(filename):
+    """Read a NIFTI file and return its image data, decompressed once and then mapped from the volume cache."""
+    if volume_cache.max_bytes > 0:
+        key = nifti_metadata.get_hash(filename)
+        image_data = volume_cache.load(key)
+        if image_data is not None:
+            return image_data
+
+    image_data = read_nifti_file(filename)
+    if volume_cache.max_bytes > 0:
+        volume_cache.store(key, image_data)
+    return image_data
+
+
+def foreground_extent(image_data, threshold, pad=1):
+    """Return the extent of the voxels above the threshold, padded and clamped to the image (None if empty)."""
+    extent = image_data.GetExtent()
+    dims = image_data.GetDimensions()
+    scalars = numpy_support.vtk_to_numpy(image_data.GetPointData().GetScalars())
+    volume = scalars.reshape(dims[2], dims[1], dims[0])
+
+    # Project the mask on each axis slab by slab, so the full-size boolean mask is never allocated
+    x_any = np.zeros(dims[0], dtype=bool)
+    y_any = np.zeros(dims[1], dtype=bool)
+    z_any = np.zeros(dims[2], dtype=bool)
+    slab_size = 16
+    for k in range(0, dims[2], slab_size):
+        slab = volume[k:k + slab_size] > threshold
+        z_any[k:k + slab_size] = slab.any(axis=(1, 2))
+        y_any |= slab.any(axis=(0, 2))
+        x_any |= slab.any(axis=(0, 1))
+
+    if not z_any.any():
+        return None
+
+    foreground = []
+    for axis, axis_any in enumerate((x_any, y_any, z_any)):
+        indices = np.flatnonzero(axis_any)
+        foreground.append(max(extent[2 * axis], extent[2 * axis] + int(indices[0]) - pad))
+        foreground.append(min(extent[2 * axis + 1], extent[2 * axis] + int(indices[-1]) + pad))
+    return tuple(foreground)
+
+
+def crop_to_foreground(image_data, threshold, pad=1):
+    """Crop an image to its padded foreground bounding box, keeping its world coordinates (None if empty)."""
+    extent = foreground_extent(image_data, threshold, pad)
+    if extent is None:
+        return None
+
+    # The VOI keeps origin and spacing and only shrinks the extent
+    voi = vtk.vtkExtractVOI()
+    voi.SetInputData(image_data)
+    voi.SetVOI(extent)
+    voi.Update()
+    return voi.GetOutput()
+
+
+def extract_surface(filename, threshold, image_data=None):
+    """Contour a NIFTI mask at the given threshold, reusing the cached mesh when possible."""
+    key = mesh_cache.make_key(filename, threshold, SURFACE_SETTINGS)
+    poly_data = mesh_cache.load(key)
+    if poly_data is not None:
+        return poly_data
+
+    if image_data is None:
+        image_data = read_nifti_image(filename)
+
+    # Contour only the bounding box of the structure, so the cost scales with the organ size
+    cropped_image = crop_to_foreground(image_data, threshold, pad=SURFACE_SETTINGS["crop_pad"])
+    if cropped_image is None:
+        poly_data = vtk.vtkPolyData()
+        mesh_cache.store(key, poly_data)
+        return poly_data
+
+    # The mapper only needs points, triangles and normals
+    if SURFACE_SETTINGS["engine"] == "flying_edges":
+        contour = vtk.vtkFlyingEdges3D()
+    else:
+        contour = vtk.vtkMarchingCubes()
+    contour.SetInputData(cropped_image)
     contour.ComputeNormalsOn()
-    contour.ComputeGradientsOn()
+    contour.ComputeGradientsOff()
+    contour.ComputeScalarsOff()
     contour.SetValue(0, threshold)
     contour.Update()
+    print(f"{os.path.basename(filename)}: surface extracted with {SURFACE_SETTINGS['engine']}")
+
+    poly_data = contour.GetOutput()
+    mesh_cache.store(key, poly_data)
+    return poly_data
+
+
+# Decimated levels of detail drawn while the camera moves: reduction of the triangle count of
+# each level, size under which a surface is always drawn at full resolution, target frame rate
+LOD_SETTINGS = {"reductions": (0.8, 0.95), "min_triangles": 20000, "target_fps": 20.0}
+
+
+def configure_level_of_detail(target_fps=None):
+    """Set the frame rate targeted while the camera moves (unset: VISU_TARGET_FPS, default 20)."""
+    target_fps = target_fps or float(os.environ.get("VISU_TARGET_FPS", LOD_SETTINGS["target_fps"]))
+    if target_fps <= 0:
+        raise ValueError(f"The target frame rate must be positive, got {target_fps}")
+    LOD_SETTINGS["target_fps"] = target_fps
+
+
+def decimate_surface(poly_data, reduction):
+    """Return a copy of the surface with the given fraction of its triangles removed (normals are kept)."""
+    decimate = vtk.vtkDecimatePro()
+    decimate.SetInputData(poly_data)
+    decimate.SetTargetReduction(reduction)
+    decimate.PreserveTopologyOff()
+    decimate.Update()
+    return decimate.GetOutput()
+
+
+def surface_levels(poly_data, key):
+    """Return the levels of detail of a surface, full resolution first, cached next to the surface itself.
+
+    Each level is decimated from the previous one. Small surfaces only have their full resolution level.
+    """
+    levels = [poly_data]
+    if poly_data.GetNumberOfPolys() < LOD_SETTINGS["min_triangles"]:
+        return levels
+
+    previous_reduction = 0.0
+    for reduction in LOD_SETTINGS["reductions"]:
+        level_key = hashlib.sha1(json.dumps([key, "lod", reduction]).encode()).hexdigest()
+        level = mesh_cache.load(level_key)
+        if level is None:
+            # Reduction relative to the previous level
+            level = decimate_surface(levels[-1], 1.0 - (1.0 - reduction) / (1.0 - previous_reduction))
+            mesh_cache.store(level_key, level)
+        levels.append(level)
+        previous_reduction = reduction
+    return levels
+
+
+def load_surface_levels(filename, threshold):
+    """Extract the surface of a NIFTI mask and its levels of detail."""
+    poly_data = extract_surface(filename, threshold)
+    return surface_levels(poly_data, mesh_cache.make_key(filename, threshold, SURFACE_SETTINGS))
+
+
+# Settings of the single-pass multi-label extraction, part of the mesh cache key
+FUSED_SURFACE_SETTINGS = {"engine": "discrete_flying_edges", "normals": True, "fused": True}
+
+
+def share_same_grid(nifti_files):
+    """Check from the headers that all files have the same extent, spacing and origin."""
+    grids = set()
+    for nifti_file in nifti_files:
+        metadata = nifti_metadata.get(nifti_file)
+        grids.add((tuple(metadata["extent"]), tuple(metadata["spacing"]), tuple(metadata["origin"])))
+    return len(grids) <= 1
+
+
+def fused_surface_keys(nifti_files, threshold):
+    """Return the mesh cache keys of the surfaces extracted from the fused label map of the files."""
+    # A label surface depends on the overlapping masks too, so the whole selection is part of the key
+    selection = [nifti_metadata.get_hash(nifti_file) for nifti_file in nifti_files]
+    settings = dict(FUSED_SURFACE_SETTINGS, selection=selection)
+    return [mesh_cache.make_key(nifti_file, threshold, settings) for nifti_file in nifti_files]
+
+
+def create_label_image(image_data, label_count):
+    """Create an empty label image on the grid of the given image."""
+    dims = image_data.GetDimensions()
+    dtype = np.uint8 if label_count < 255 else np.uint16
+    labels = np.zeros(dims[0] * dims[1] * dims[2], dtype=dtype)
+
+    label_image = vtk.vtkImageData()
+    label_image.CopyStructure(image_data)
+    scalars = numpy_support.numpy_to_vtk(labels, deep=1)
+    scalars.SetName("Labels")
+    label_image.GetPointData().SetScalars(scalars)
+    return label_image
+
+
+def add_mask_to_label_layers(label_layers, image_data, threshold, label, label_count):
+    """Write a mask into the first label image it does not overlap, adding a new one if needed."""
+    # Masks may overlap (e.g. BrainStem lies inside Brain), overlapping masks go to separate layers
+    mask = numpy_support.vtk_to_numpy(image_data.GetPointData().GetScalars()) > threshold
+    for label_image, layer_labels in label_layers:
+        labels = numpy_support.vtk_to_numpy(label_image.GetPointData().GetScalars())
+        if not labels[mask].any():
+            break
+    else:
+        label_image = create_label_image(image_data, label_count)
+        layer_labels = []
+        label_layers.append((label_image, layer_labels))
+        labels = numpy_support.vtk_to_numpy(label_image.GetPointData().GetScalars())
+
+    labels[mask] = label
+    layer_labels.append(label)
+    label_image.GetPointData().GetScalars().Modified()
+
+
+def extract_label_surfaces(label_image, labels):
+    """Extract the surfaces of the given labels in one pass, returning a polydata per label."""
+    cropped_image = crop_to_foreground(label_image, 0, pad=1)
+    if cropped_image is None:
+        return {label: vtk.vtkPolyData() for label in labels}
+
+    contour = vtk.vtkDiscreteFlyingEdges3D()
+    contour.SetInputData(cropped_image)
+    for index, label in enumerate(labels):
+        contour.SetValue(index, label)
+    contour.ComputeNormalsOff()
+    contour.ComputeGradientsOff()
+    contour.ComputeScalarsOn()
+    contour.Update()
 
+    # Split the output by label, normals are computed per label so they always point outwards
+    surfaces = {}
+    for label in labels:
+        threshold = vtk.vtkThreshold()
+        threshold.SetInputData(contour.GetOutput())
+        threshold.SetThresholdFunction(vtk.vtkThreshold.THRESHOLD_BETWEEN)
+        threshold.SetLowerThreshold(label)
+        threshold.SetUpperThreshold(label)
+
+        geometry = vtk.vtkGeometryFilter()
+        geometry.SetInputConnection(threshold.GetOutputPort())
+
+        normals = vtk.vtkPolyDataNormals()
+        normals.SetInputConnection(geometry.GetOutputPort())
+        normals.SplittingOff()
+        normals.ConsistencyOn()
+        normals.AutoOrientNormalsOn()
+        normals.Update()
+        surfaces[label] = normals.GetOutput()
+    return surfaces
+
+
+# Available volume rendering modes: one label volume for all structures, or one volume per file
+VOLUME_MODES = ("combined", "per_file")
+
+# Volume rendering settings, the opacity is the one of a fully opaque structure in combined mode,
+# the budget is the memory the volumes of a window may hold before the least recently shown are released
+VOLUME_SETTINGS = {
+    "mode": "combined",
+    "opacity": 0.3,
+    "interactive_shrink": 2,
+    "max_image_sample_distance": 4.0,
+    "budget_bytes": 2048 * 2**20,
+}
+
+
+def configure_volume_rendering(mode=None, budget_mb=None):
+    """Select the volume rendering mode (unset: VISU_VOLUME_MODE, default combined) and the memory budget
+    of the volumes in MB (unset: VISU_VOLUME_BUDGET_MB, default 2048, 0 for no limit)."""
+    mode = mode or os.environ.get("VISU_VOLUME_MODE", "combined")
+    if mode not in VOLUME_MODES:
+        raise ValueError(f"Unknown volume mode {mode!r}, expected one of {VOLUME_MODES}")
+    VOLUME_SETTINGS["mode"] = mode
+
+    if budget_mb is None:
+        budget_mb = float(os.environ.get("VISU_VOLUME_BUDGET_MB", VOLUME_SETTINGS["budget_bytes"] / 2**20))
+    if budget_mb < 0:
+        raise ValueError(f"The volume memory budget must not be negative, got {budget_mb}")
+    VOLUME_SETTINGS["budget_bytes"] = int(budget_mb * 2**20)
+
+
+def data_nbytes(data_object):
+    """Return the memory held by a VTK data object, in bytes."""
+    return data_object.GetActualMemorySize() * 1024
+
+
+class MemoryBudget:
+    """Sizes of the entries held in memory, from the least to the most recently used."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes  # 0 for no limit
+        self.entries = {}  # Key -> size in bytes, dicts keep their insertion order
+
+    def add(self, key, nbytes):
+        """Add an entry, or update its size, as the most recently used."""
+        self.entries.pop(key, None)
+        self.entries[key] = nbytes
+
+    def touch(self, key):
+        """Mark an entry as the most recently used."""
+        if key in self.entries:
+            self.entries[key] = self.entries.pop(key)
+
+    def discard(self, key):
+        """Forget an entry (no error if it is missing)."""
+        self.entries.pop(key, None)
+
+    def total(self):
+        """Return the size of all the entries."""
+        return sum(self.entries.values())
+
+    def over_budget(self, keep=()):
+        """Return the least recently used entries to release to fit in the budget, never the ones in keep."""
+        excess = self.total() - self.max_bytes
+        released = []
+        if self.max_bytes <= 0:
+            return released
+        for key, nbytes in self.entries.items():
+            if excess <= 0:
+                break
+            if key not in keep:
+                released.append(key)
+                excess -= nbytes
+        return released
+
+
+def create_combined_label_image(voxel_masks, pad=1):
+    """Expand voxel masks into one label image covering their bounding boxes (label i+1 for the i-th mask).
+
+    Masks must come from images on the same grid, missing (None) masks get no voxels.
+    Where masks overlap, the smaller structure is kept so that it stays visible inside the larger one.
+    """
+    labeled_masks = [(label, voxel_mask) for label, voxel_mask in enumerate(voxel_masks, start=1) if voxel_mask]
+    if not labeled_masks:
+        return None
+    low = np.min([voxel_mask.extent[0::2] for _, voxel_mask in labeled_masks], axis=0) - pad
+    high = np.max([voxel_mask.extent[1::2] for _, voxel_mask in labeled_masks], axis=0) + pad
+    dtype = np.uint8 if len(voxel_masks) < 255 else np.uint16
+    labels = np.zeros(tuple(high[::-1] - low[::-1] + 1), dtype=dtype)
+
+    # Larger structures are written first, smaller ones over them
+    for label, voxel_mask in sorted(labeled_masks, key=lambda labeled: -labeled[1].voxel_count()):
+        i0, j0, k0 = np.array(voxel_mask.extent[0::2]) - low
+        k_size, j_size, i_size = voxel_mask.shape
+        labels[k0:k0 + k_size, j0:j0 + j_size, i0:i0 + i_size][voxel_mask.dense()] = label
+
+    label_image = vtk.vtkImageData()
+    label_image.SetExtent(low[0], high[0], low[1], high[1], low[2], high[2])
+    label_image.SetSpacing(labeled_masks[0][1].spacing)
+    label_image.SetOrigin(labeled_masks[0][1].origin)
+    scalars = numpy_support.numpy_to_vtk(labels.ravel(), deep=1)
+    scalars.SetName("Labels")
+    label_image.GetPointData().SetScalars(scalars)
+    return label_image
+
+
+class LabelMap:
+    """Label image viewed as a NumPy array indexed [k, j, i], for world-to-voxel lookups."""
+
+    def __init__(self, label_image):
+        dims = label_image.GetDimensions()
+        self.image = label_image  # Owns the array below
+        self.labels = numpy_support.vtk_to_numpy(label_image.GetPointData().GetScalars()).reshape(
+            dims[2], dims[1], dims[0]
+        )
+        self.extent = label_image.GetExtent()
+        self.spacing = np.array(label_image.GetSpacing(), dtype=float)
+        self.origin = np.array(label_image.GetOrigin(), dtype=float)
+
+    def bounds(self):
+        """Return the world bounds covered by the voxels (voxels are centered on points)."""
+        first = self.origin + (np.array(self.extent[0::2]) - 0.5) * self.spacing
+        last = self.origin + (np.array(self.extent[1::2]) + 0.5) * self.spacing
+        low, high = np.minimum(first, last), np.maximum(first, last)
+        return (low[0], high[0], low[1], high[1], low[2], high[2])
+
+    def label_at(self, points):
+        """Return the label of the voxel containing each point (0 outside the image)."""
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        index = np.rint((points - self.origin) / self.spacing).astype(int) - np.array(self.extent[0::2])
+        inside = np.all((index >= 0) & (index < np.array(self.labels.shape[::-1])), axis=1)
+        labels = np.zeros(len(points), dtype=self.labels.dtype)
+        i, j, k = index[inside].T
+        labels[inside] = self.labels[k, j, i]
+        return labels
+
+    def first_label(self, start_point, end_point):
+        """Return the first non-zero label met going from start_point to end_point (0 if none)."""
+        start = np.asarray(start_point, dtype=float)
+        direction = np.asarray(end_point, dtype=float) - start
+        length = np.linalg.norm(direction)
+        if length == 0:
+            return 0
+        direction /= length
+        t_enter, t_exit = ray_box_intervals(start[None], direction[None], [self.bounds()])
+        t_start, t_stop = max(t_enter[0, 0], 0.0), min(t_exit[0, 0], length)
+        if not t_start < t_stop:
+            return 0
+
+        # Sample the segment inside the image at half the smallest voxel size
+        steps = np.arange(t_start, t_stop, np.abs(self.spacing).min() / 2)
+        labels = self.label_at(start + steps[:, None] * direction)
+        hits = np.flatnonzero(labels)
+        return int(labels[hits[0]]) if hits.size else 0
+
+
+def create_volume_mapper(image_data):
+    """Create a GPU ray cast mapper whose sample distances adapt to the frame rate asked by the interactor.
+
+    While the camera moves, the interactor asks for the target frame rate and the mapper samples the
+    volume and the image more coarsely; at rest it renders at full quality.
+    """
+    volume_mapper = vtk.vtkGPUVolumeRayCastMapper()
+    volume_mapper.SetInputData(image_data)
+    volume_mapper.AutoAdjustSampleDistancesOn()
+    volume_mapper.SetMinimumImageSampleDistance(1.0)
+    volume_mapper.SetMaximumImageSampleDistance(VOLUME_SETTINGS["max_image_sample_distance"])
+    return volume_mapper
+
+
+def downsample_volume(image_data, factor):
+    """Return a copy of the image keeping one voxel out of factor along its finest axes.
+
+    Axes whose spacing is already coarse (e.g. thick slices) are shrunk less, voxel values are
+    picked rather than averaged so that labels stay valid.
+    """
+    spacing = np.abs(np.array(image_data.GetSpacing(), dtype=float))
+    factors = [max(1, int(factor * spacing.min() / axis_spacing)) for axis_spacing in spacing]
+    shrink = vtk.vtkImageShrink3D()
+    shrink.SetInputData(image_data)
+    shrink.SetShrinkFactors(*factors)
+    shrink.AveragingOff()
+    shrink.Update()
+    return shrink.GetOutput()
+
+
+def create_label_volume_actor(label_image, colors, opacities):
+    """Create a single volume actor rendering each label with its own color and opacity."""
+    volume_mapper = create_volume_mapper(label_image)
+
+    # One color and opacity per label value, the background (0) is transparent
+    color_func = vtk.vtkColorTransferFunction()
+    opacity_func = vtk.vtkPiecewiseFunction()
+    color_func.AddRGBPoint(0, 0.0, 0.0, 0.0)
+    opacity_func.AddPoint(0, 0.0)
+    for label, (color, opacity) in enumerate(zip(colors, opacities), start=1):
+        color_func.AddRGBPoint(label, *color)
+        opacity_func.AddPoint(label, opacity)
+
+    # Nearest interpolation, so label values are never blended together
+    volume_property = vtk.vtkVolumeProperty()
+    volume_property.SetColor(color_func)
+    volume_property.SetScalarOpacity(opacity_func)
+    volume_property.SetInterpolationTypeToNearest()
+
+    volume_actor = vtk.vtkVolume()
+    volume_actor.SetMapper(volume_mapper)
+    volume_actor.SetProperty(volume_property)
+    return volume_actor
+
+
+def set_label_appearance(volume_actor, label, color, opacity):
+    """Change the color and opacity of one label of a volume made by create_label_volume_actor()."""
+    volume_property = volume_actor.GetProperty()
+    # Adding a point where one already exists replaces it
+    volume_property.GetRGBTransferFunction().AddRGBPoint(label, *color)
+    volume_property.GetScalarOpacity().AddPoint(label, opacity)
+
+
+def create_surface_mapper(poly_data):
+    """Create a mapper drawing a surface mesh with the color of its actor."""
     mapper = vtk.vtkPolyDataMapper()
-    mapper.SetInputConnection(contour.GetOutputPort())
+    mapper.SetInputData(poly_data)
     mapper.ScalarVisibilityOff()
+    return mapper
+
 
+def create_surface_actor(poly_data, color):
+    """Create a VTK actor displaying a surface mesh with the given color."""
     actor = vtk.vtkActor()
-    actor.SetMapper(mapper)
+    actor.SetMapper(create_surface_mapper(poly_data))
     actor.GetProperty().SetDiffuseColor(color)
     actor.GetProperty().SetDiffuse(1.0)
     actor.GetProperty().SetSpecular(0.0)
 
-    return actor, label
+    return actor
+
+
+# "actors" draws each surface with its own actor, "composite" all of them with one composite mapper
+SURFACE_RENDER_MODES = ("actors", "composite")
+RENDER_SETTINGS = {"surfaces": "actors"}
+
+
+def configure_surface_rendering(mode=None):
+    """Select how the surfaces are drawn (unset: VISU_SURFACE_MODE, default actors)."""
+    mode = mode or os.environ.get("VISU_SURFACE_MODE", "actors")
+    if mode not in SURFACE_RENDER_MODES:
+        raise ValueError(f"Unknown surface rendering mode {mode!r}, expected one of {SURFACE_RENDER_MODES}")
+    RENDER_SETTINGS["surfaces"] = mode
+
+
+class CompositeSurfaces:
+    """All surfaces drawn by a single actor, one block per structure in a composite dataset.
+
+    Each structure keeps a handle actor that is not rendered: its color, opacity and visibility are
+    copied to its block with update(). There is one dataset and mapper per level of detail.
+    """
+
+    def __init__(self, level_count):
+        self.handles = []
+        self.block_indices = {}
+        self.datasets = []
+        self.mappers = []
+        for _ in range(level_count):
+            dataset = vtk.vtkMultiBlockDataSet()
+            mapper = vtk.vtkCompositePolyDataMapper()
+            mapper.SetInputDataObject(dataset)
+            mapper.ScalarVisibilityOff()
+            mapper.SetCompositeDataDisplayAttributes(vtk.vtkCompositeDataDisplayAttributes())
+            self.datasets.append(dataset)
+            self.mappers.append(mapper)
+
+        self.actor = vtk.vtkActor()
+        self.actor.SetMapper(self.mappers[0])
+        self.actor.GetProperty().SetDiffuse(1.0)
+        self.actor.GetProperty().SetSpecular(0.0)
+
+        # Reused for every pick, reports the block under the cursor
+        self.selector = vtk.vtkHardwareSelector()
+        self.selector.SetFieldAssociation(vtk.vtkDataObject.FIELD_ASSOCIATION_CELLS)
+
+    def add(self, handle, levels):
+        """Add the levels of detail of a structure as a new block, drawn like its handle actor."""
+        index = len(self.handles)
+        self.handles.append(handle)
+        self.block_indices[handle] = index
+        for level, dataset in enumerate(self.datasets):
+            dataset.SetBlock(index, levels[min(level, len(levels) - 1)])
+            dataset.Modified()
+        self.update(handle)
+
+    def remove(self, handle):
+        """Remove the blocks of a structure, the blocks after it move down by one."""
+        index = self.block_indices.pop(handle)
+        self.handles.pop(index)
+        for dataset, mapper in zip(self.datasets, self.mappers):
+            attributes = mapper.GetCompositeDataDisplayAttributes()
+            block = dataset.GetBlock(index)
+            attributes.RemoveBlockColor(block)
+            attributes.RemoveBlockOpacity(block)
+            attributes.RemoveBlockVisibility(block)
+            for block_index in range(index, len(self.handles)):
+                dataset.SetBlock(block_index, dataset.GetBlock(block_index + 1))
+            dataset.SetNumberOfBlocks(len(self.handles))
+            dataset.Modified()
+            mapper.Modified()
+        for block_index in range(index, len(self.handles)):
+            self.block_indices[self.handles[block_index]] = block_index
+
+    def update(self, handle):
+        """Copy the color, opacity and visibility of a handle actor to its blocks."""
+        index = self.block_indices[handle]
+        color = handle.GetProperty().GetDiffuseColor()
+        opacity = handle.GetProperty().GetOpacity()
+        visible = bool(handle.GetVisibility())
+        for dataset, mapper in zip(self.datasets, self.mappers):
+            block = dataset.GetBlock(index)
+            attributes = mapper.GetCompositeDataDisplayAttributes()
+            attributes.SetBlockColor(block, color)
+            attributes.SetBlockOpacity(block, opacity)
+            attributes.SetBlockVisibility(block, visible)
+            mapper.Modified()
+
+    def set_level(self, level):
+        """Draw the given level of detail."""
+        self.actor.SetMapper(self.mappers[min(level, len(self.mappers) - 1)])
+
+    def pick(self, renderer, x, y):
+        """Return the handle of the structure drawn at the display position (None if there is none)."""
+        self.selector.SetRenderer(renderer)
+        self.selector.SetArea(x, y, x, y)
+        selection = self.selector.Select()
+        for node_index in range(selection.GetNumberOfNodes()):
+            properties = selection.GetNode(node_index).GetProperties()
+            if properties.Get(vtk.vtkSelectionNode.PROP()) is not self.actor:
+                continue
+            # Flat index of a block: the multiblock itself is 0, its i-th leaf is i + 1
+            if properties.Has(vtk.vtkSelectionNode.COMPOSITE_INDEX()):
+                index = properties.Get(vtk.vtkSelectionNode.COMPOSITE_INDEX()) - 1
+                if 0 <= index < len(self.handles):
+                    return self.handles[index]
+        return None
+
+
+def load_nifti_as_actor(filename, threshold, color, label):
+    """Load a NIFTI file and create a VTK actor with contours."""
+    poly_data = extract_surface(filename, threshold)
+    return create_surface_actor(poly_data, color), label
+
+
+class StructureLoader(QObject):
+    """Read and contour NIFTI files on a thread pool, reporting each structure as soon as it is ready.
+
+    A structure is reported with the list of its levels of detail, full resolution first.
+    """
+
+    structure_loaded = pyqtSignal(str, object)
+    structure_failed = pyqtSignal(str, str)
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal()
+
+    def __init__(self, nifti_files, threshold, max_workers=None):
+        super().__init__()
+        self.nifti_files = list(nifti_files)
+        self.threshold = threshold
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.executor = None
+        self.futures = []
+        self.done_count = 0
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Submit every file to the pool, smallest first so that small structures show up early."""
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        for nifti_file in sorted(self.nifti_files, key=os.path.getsize):
+            future = self.executor.submit(load_surface_levels, nifti_file, self.threshold)
+            future.add_done_callback(
+                lambda future, nifti_file=nifti_file: self.on_done(nifti_file, future)
+            )
+            self.futures.append(future)
+        self.executor.shutdown(wait=False)
+
+    def on_done(self, nifti_file, future):
+        """Report a finished job (runs on a worker thread, signals are queued to the GUI thread)."""
+        if self.cancelled or future.cancelled():
+            return
+
+        error = future.exception()
+        if error is None:
+            self.structure_loaded.emit(nifti_file, future.result())
+        else:
+            self.structure_failed.emit(nifti_file, str(error))
+
+        with self.lock:
+            self.done_count += 1
+            done_count = self.done_count
+        self.progress.emit(done_count, len(self.nifti_files))
+        if done_count == len(self.nifti_files):
+            self.finished.emit()
+
+    def cancel(self):
+        """Drop the pending jobs, the running ones finish but their result is ignored."""
+        self.cancelled = True
+        for future in self.futures:
+            future.cancel()
+
+
+class LatestOnlyWorker(QObject):
+    """Run background tasks one at a time, only the most recent request is run and reported."""
+
+    result_ready = pyqtSignal(int, object)
+
+    def __init__(self):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.running = False
+        self.pending = None
+
+    def submit(self, function, *args):
+        """Request a task, replacing any request that has not started yet. Returns its generation.
+
+        The task is called with an extra is_outdated() argument it can poll to stop early.
+        """
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            self.pending = (generation, function, args)
+            job = self.take_pending()
+        # Started without the lock: a task that is already done runs on_done() right away on this thread
+        if job is not None:
+            self.start(job)
+        return generation
+
+    def take_pending(self):
+        """Take the pending request if no task is running and mark the worker running (called with the lock held)."""
+        if self.running or self.pending is None:
+            return None
+        job = self.pending
+        self.pending = None
+        self.running = True
+        return job
+
+    def start(self, job):
+        """Run a request taken by take_pending() on the worker thread (called without the lock)."""
+        generation, function, args = job
+        def is_outdated():
+            return generation != self.generation
+
+        future = self.executor.submit(function, *args, is_outdated)
+        future.add_done_callback(lambda future: self.on_done(generation, future))
+
+    def on_done(self, generation, future):
+        """Report the result if no newer request arrived meanwhile, then start the pending request."""
+        error = future.exception()
+        if error is not None:
+            print(f"Background task failed: {error}")
+        elif generation == self.generation:
+            self.result_ready.emit(generation, future.result())
+
+        with self.lock:
+            self.running = False
+            job = self.take_pending()
+        if job is not None:
+            self.start(job)
+
+    def cancel(self):
+        """Drop the pending request and make the running one outdated."""
+        with self.lock:
+            self.generation += 1
+            self.pending = None
+
+    def shutdown(self):
+        """Cancel everything and stop the worker thread once the running task returns."""
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
+
+class FusedStructureLoader(StructureLoader):
+    """Fuse all masks into one label map and extract every surface in a single multi-label pass."""
+
+    def start(self):
+        """Run the fused extraction in the background, or load file by file if the grids differ."""
+        if not share_same_grid(self.nifti_files):
+            print("Structures do not share the same grid, loading them one by one.")
+            super().start()
+            return
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Read and fuse the masks in parallel, then extract and report all the surfaces."""
+        try:
+            surfaces = self.load_surfaces()
+        except Exception as e:
+            for nifti_file in self.nifti_files:
+                self.structure_failed.emit(nifti_file, str(e))
+            self.finished.emit()
+            return
+
+        if self.cancelled:
+            return
+        for nifti_file, levels in zip(self.nifti_files, surfaces):
+            self.structure_loaded.emit(nifti_file, levels)
+        self.progress.emit(len(self.nifti_files), len(self.nifti_files))
+        self.finished.emit()
+
+    def load_surfaces(self):
+        """Return the levels of detail of every file, the surfaces being extracted in one multi-label pass."""
+        keys = fused_surface_keys(self.nifti_files, self.threshold)
+        surfaces = self.extract_surfaces(keys)
+        if self.cancelled:
+            return []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(surface_levels, surfaces, keys))
+
+    def extract_surfaces(self, keys):
+        """Return the surface of every file, from the mesh cache or from one multi-label pass."""
+        surfaces = [mesh_cache.load(key) for key in keys]
+        if all(surface is not None for surface in surfaces):
+            return surfaces
+
+        label_count = len(self.nifti_files)
+        label_layers = []
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = {
+            self.executor.submit(read_nifti_image, nifti_file): label
+            for label, nifti_file in enumerate(self.nifti_files, start=1)
+        }
+        self.futures = list(futures)
+        self.executor.shutdown(wait=False)
+
+        # Fuse each mask as soon as it is read, so only a few full-size images are alive at once
+        for done_count, future in enumerate(as_completed(futures), start=1):
+            if self.cancelled:
+                return []
+            image_data = future.result()
+            add_mask_to_label_layers(label_layers, image_data, self.threshold, futures[future], label_count)
+            del image_data
+            self.progress.emit(done_count - 1, label_count)
+
+        # One multi-label pass per layer, a single one unless masks overlap
+        surfaces_by_label = {}
+        for label_image, layer_labels in label_layers:
+            surfaces_by_label.update(extract_label_surfaces(label_image, sorted(layer_labels)))
+        print(f"Surfaces extracted with discrete_flying_edges in {len(label_layers)} pass(es)")
+        surfaces = [surfaces_by_label[label] for label in range(1, label_count + 1)]
+        for key, poly_data in zip(keys, surfaces):
+            mesh_cache.store(key, poly_data)
+        return surfaces
+
+
+def segment_hits_boxes(start_point, end_point, bounds):
+    """Return which axis-aligned boxes (N x 6 bounds) the segment crosses: the slab test of
+    ray_box_intervals() with the segment as direction, clipped to the segment."""
+    start = np.asarray(start_point, dtype=float)
+    direction = np.asarray(end_point, dtype=float) - start
+    t_enter, t_exit = ray_box_intervals(start[None, :], direction[None, :], bounds)
+
+    # Empty surfaces have inverted bounds and are never hit
+    return np.maximum(t_enter[0], 0.0) <= np.minimum(t_exit[0], 1.0)
+
+
+def ray_directions(azimuths, elevations):
+    """Return unit ray directions (N x 3) for azimuth and elevation angles in degrees, as in the ray simulation."""
+    azimuths = np.radians(np.asarray(azimuths, dtype=float))
+    elevations = np.radians(np.asarray(elevations, dtype=float))
+    return np.stack([
+        np.cos(elevations) * np.cos(azimuths),
+        np.cos(elevations) * np.sin(azimuths),
+        np.sin(elevations),
+    ], axis=-1)
+
+
+def ray_box_intervals(origins, directions, bounds):
+    """Return the parametric intervals (t_enter, t_exit), each N x B, where N rays cross B boxes."""
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 3, 2)
+    origins = np.asarray(origins, dtype=float)[:, None, :]
+    directions = np.asarray(directions, dtype=float)[:, None, :]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_low = (bounds[None, :, :, 0] - origins) / directions
+        t_high = (bounds[None, :, :, 1] - origins) / directions
+    t_enter = np.minimum(t_low, t_high)
+    t_exit = np.maximum(t_low, t_high)
+
+    # On an axis parallel to the ray, the slab is either always or never crossed
+    parallel = directions == 0
+    inside = (origins >= bounds[None, :, :, 0]) & (origins <= bounds[None, :, :, 1])
+    t_enter = np.where(parallel, np.where(inside, -np.inf, np.inf), t_enter)
+    t_exit = np.where(parallel, np.where(inside, np.inf, -np.inf), t_exit)
+    return t_enter.max(axis=2), t_exit.min(axis=2)
+
+
+def polydata_triangles(poly_data):
+    """Return the triangles of a surface as a T x 3 x 3 array of vertex coordinates."""
+    if poly_data.GetNumberOfPolys() == 0:
+        return np.zeros((0, 3, 3))
+
+    offsets = numpy_support.vtk_to_numpy(poly_data.GetPolys().GetOffsetsArray())
+    if not np.all(np.diff(offsets) == 3):
+        triangle_filter = vtk.vtkTriangleFilter()
+        triangle_filter.SetInputData(poly_data)
+        triangle_filter.Update()
+        poly_data = triangle_filter.GetOutput()
+
+    points = numpy_support.vtk_to_numpy(poly_data.GetPoints().GetData()).astype(float)
+    connectivity = numpy_support.vtk_to_numpy(poly_data.GetPolys().GetConnectivityArray())
+    return points[connectivity.reshape(-1, 3)]
+
+
+class RayCastMesh:
+    """Triangles of a surface packed in small spatially coherent chunks, for vectorized ray casting."""
+
+    def __init__(self, poly_data, chunk_size=256):
+        # Contouring filters emit triangles slice by slice, so consecutive triangles are close to each other
+        triangles = polydata_triangles(poly_data)
+        chunk_count = max(1, -(-len(triangles) // chunk_size))
+        padded = np.zeros((chunk_count * chunk_size, 3, 3))
+        padded[:len(triangles)] = triangles
+        padded = padded.reshape(chunk_count, chunk_size, 3, 3)
+
+        # Padding triangles are degenerate and never hit
+        self.vertex0 = padded[:, :, 0]
+        self.edge1 = padded[:, :, 1] - padded[:, :, 0]
+        self.edge2 = padded[:, :, 2] - padded[:, :, 0]
+
+        self.chunk_bounds = np.zeros((chunk_count, 6))
+        for chunk in range(chunk_count):
+            chunk_triangles = triangles[chunk * chunk_size:(chunk + 1) * chunk_size].reshape(-1, 3)
+            if len(chunk_triangles):
+                self.chunk_bounds[chunk, 0::2] = chunk_triangles.min(axis=0)
+                self.chunk_bounds[chunk, 1::2] = chunk_triangles.max(axis=0)
+            else:
+                self.chunk_bounds[chunk] = (1, -1, 1, -1, 1, -1)
+        self.bounds = poly_data.GetBounds()
+
+
+def cast_rays(origins, directions, meshes, max_length=np.inf, block_size=1024):
+    """Cast N rays against M surfaces at once, without a Python loop over rays or triangles.
+
+    origins and directions are N x 3 arrays (directions are normalized, so distances are in world
+    units) and meshes is a list of vtkPolyData or RayCastMesh. Returns (hit, entry, exit), N x M
+    arrays with the hit flag and the distances along each ray where it enters and leaves each
+    surface (NaN when missed). Entry is 0 for a ray starting inside a surface, and exit is
+    max_length for a ray whose segment ends inside it.
+    """
+    origins = np.atleast_2d(np.asarray(origins, dtype=float))
+    directions = np.atleast_2d(np.asarray(directions, dtype=float))
+    directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+    ray_count = len(origins)
+
+    hit = np.zeros((ray_count, len(meshes)), dtype=bool)
+    entry = np.full((ray_count, len(meshes)), np.nan)
+    exit = np.full((ray_count, len(meshes)), np.nan)
+
+    for index, mesh in enumerate(meshes):
+        if not isinstance(mesh, RayCastMesh):
+            mesh = RayCastMesh(mesh)
+
+        # Broad phase on the chunk boxes, giving the (ray, chunk) pairs worth an exact test. The whole
+        # ray is tested, not only its first max_length, since the crossings beyond tell whether it ends inside
+        t_enter, t_exit = ray_box_intervals(origins, directions, mesh.chunk_bounds)
+        ray_indices, chunk_indices = np.nonzero((t_enter <= t_exit) & (t_exit >= 0))
+        hit_rays = []
+        hit_ts = []
+
+        # Narrow phase: Moller-Trumbore on every triangle of the selected chunks, block by block
+        for start in range(0, len(ray_indices), block_size):
+            rays = ray_indices[start:start + block_size]
+            chunks = chunk_indices[start:start + block_size]
+            origin = origins[rays][:, None, :]
+            direction = directions[rays][:, None, :]
+            vertex0 = mesh.vertex0[chunks]
+            edge1 = mesh.edge1[chunks]
+            edge2 = mesh.edge2[chunks]
+
+            p_vector = np.cross(direction, edge2)
+            determinant = np.einsum("ijk,ijk->ij", edge1, p_vector)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                inverse = 1.0 / determinant
+                t_vector = origin - vertex0
+                u = np.einsum("ijk,ijk->ij", t_vector, p_vector) * inverse
+                q_vector = np.cross(t_vector, edge1)
+                v = np.einsum("ijk,ijk->ij", np.broadcast_to(direction, q_vector.shape), q_vector) * inverse
+                t = np.einsum("ijk,ijk->ij", edge2, q_vector) * inverse
+                hits = (np.abs(determinant) > 1e-12) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+
+            hit_pairs, _ = np.nonzero(hits)
+            hit_rays.append(rays[hit_pairs])
+            hit_ts.append(t[hits])
+
+        # A ray through an edge or vertex hits every triangle sharing it, these hits count as one crossing
+        hit_rays = np.concatenate(hit_rays) if hit_rays else np.zeros(0, dtype=np.int64)
+        hit_ts = np.concatenate(hit_ts) if hit_ts else np.zeros(0)
+        order = np.lexsort((hit_ts, hit_rays))
+        hit_rays = hit_rays[order]
+        hit_ts = hit_ts[order]
+        duplicate = np.zeros(len(hit_ts), dtype=bool)
+        duplicate[1:] = (hit_rays[1:] == hit_rays[:-1]) & (
+            hit_ts[1:] - hit_ts[:-1] <= 1e-9 * np.maximum(1.0, np.abs(hit_ts[1:]))
+        )
+        hit_rays = hit_rays[~duplicate]
+        hit_ts = hit_ts[~duplicate]
+
+        # Inside or outside from the parity of the crossings of the whole ray, and of those past its end
+        starts_inside = np.bincount(hit_rays, minlength=ray_count) % 2 == 1
+        within = hit_ts <= max_length
+        ends_inside = np.bincount(hit_rays[~within], minlength=ray_count) % 2 == 1
+
+        t_min = np.full(ray_count, np.inf)
+        t_max = np.full(ray_count, -np.inf)
+        np.minimum.at(t_min, hit_rays[within], hit_ts[within])
+        np.maximum.at(t_max, hit_rays[within], hit_ts[within])
+
+        was_hit = starts_inside | np.isfinite(t_min)
+        hit[:, index] = was_hit
+        entry[was_hit, index] = np.where(starts_inside, 0.0, t_min)[was_hit]
+        exit[was_hit, index] = np.where(ends_inside, max_length, t_max)[was_hit]
+
+    return hit, entry, exit
+
+
+def load_surface_meshes(nifti_files, threshold=0.5):
+    """Return the surface of each file (from the mesh cache when possible), e.g. for cast_rays()."""
+    return [extract_surface(nifti_file, threshold) for nifti_file in nifti_files]
+
+
+class VoxelMask:
+    """Binary mask of a structure cropped to its bounding box, in the world coordinates of its image.
+
+    The voxels are kept bit-packed (8 per byte) and only expanded by dense() or to_image_data().
+    """
+
+    def __init__(self, mask, extent, spacing, origin, value=1, dtype=np.uint8):
+        mask = np.asarray(mask, dtype=bool)
+        self.shape = mask.shape  # Indexed [k, j, i]
+        self.bits = np.packbits(mask, axis=None)
+        self.count = int(np.count_nonzero(mask))
+        self.extent = tuple(extent)
+        self.spacing = tuple(spacing)
+        self.origin = tuple(origin)
+        # Value and type of the structure's voxels in its image, restored by to_image_data()
+        self.value = value
+        self.dtype = np.dtype(dtype)
+
+    def dense(self):
+        """Return the cropped mask as a boolean array indexed [k, j, i]."""
+        size = int(np.prod(self.shape))
+        return np.unpackbits(self.bits, count=size).reshape(self.shape).view(bool)
+
+    def voxel_count(self):
+        """Return the number of voxels in the structure."""
+        return self.count
+
+    def nbytes(self):
+        """Return the memory used by the packed voxels."""
+        return self.bits.nbytes
+
+    def to_image_data(self, pad=1):
+        """Expand the mask into an image of its bounding box grown by pad voxels, at its place in the world.
+
+        The voxels of the structure get their original value, the others 0.
+        """
+        voxels = np.zeros(tuple(size + 2 * pad for size in self.shape), dtype=self.dtype)
+        voxels[pad:pad + self.shape[0], pad:pad + self.shape[1], pad:pad + self.shape[2]][self.dense()] = self.value
+
+        image_data = vtk.vtkImageData()
+        image_data.SetExtent([bound - pad if n % 2 == 0 else bound + pad for n, bound in enumerate(self.extent)])
+        image_data.SetSpacing(self.spacing)
+        image_data.SetOrigin(self.origin)
+        image_data.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels.ravel(), deep=False))
+        return image_data
+
+    def cell_bounds(self):
+        """Return the world bounds covered by the voxels of the cropped box (voxels are centered on points)."""
+        bounds = []
+        for axis in range(3):
+            low = self.origin[axis] + (self.extent[2 * axis] - 0.5) * self.spacing[axis]
+            high = self.origin[axis] + (self.extent[2 * axis + 1] + 0.5) * self.spacing[axis]
+            bounds.extend([min(low, high), max(low, high)])
+        return tuple(bounds)
+
+
+def load_voxel_mask(filename, threshold=0.5):
+    """Read a NIFTI mask and keep only the voxels of its bounding box (None if it is empty)."""
+    image_data = read_nifti_image(filename)
+    extent = foreground_extent(image_data, threshold, pad=0)
+    if extent is None:
+        return None
+
+    dims = image_data.GetDimensions()
+    full_extent = image_data.GetExtent()
+    scalars = numpy_support.vtk_to_numpy(image_data.GetPointData().GetScalars())
+    volume = scalars.reshape(dims[2], dims[1], dims[0])
+    i0, i1, j0, j1, k0, k1 = [extent[n] - full_extent[2 * (n // 2)] for n in range(6)]
+    box = volume[k0:k1 + 1, j0:j1 + 1, i0:i1 + 1]
+    mask = box > threshold
+    return VoxelMask(
+        mask, extent, image_data.GetSpacing(), image_data.GetOrigin(), value=box[mask].max(), dtype=box.dtype
+    )
+
+
+def trace_voxel_rays(origins, directions, masks, max_length=np.inf):
+    """Walk N rays through the voxels of M masks with a 3D-DDA (Amanatides-Woo) traversal.
+
+    The traversal is vectorized over rays, its number of steps is bounded by the size of each
+    mask's bounding box. Returns (hit, path_length, entry, exit), N x M arrays with the hit flag,
+    the length of each ray inside each structure and the distances where it first enters and last
+    leaves it (NaN when missed). Directions are normalized, so lengths are in world units.
+    """
+    origins = np.atleast_2d(np.asarray(origins, dtype=float))
+    directions = np.atleast_2d(np.asarray(directions, dtype=float))
+    directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+    ray_count = len(origins)
+
+    path_length = np.zeros((ray_count, len(masks)))
+    entry = np.full((ray_count, len(masks)), np.nan)
+    exit = np.full((ray_count, len(masks)), np.nan)
+
+    for index, voxel_mask in enumerate(masks):
+        if voxel_mask is None:
+            continue
+        mask = voxel_mask.dense()
+        shape = np.array(mask.shape[::-1])  # Voxel counts along x, y, z
+        spacing = np.abs(np.array(voxel_mask.spacing, dtype=float))
+        bounds = voxel_mask.cell_bounds()
+        box_min = np.array(bounds[0::2])
+
+        # Clip the rays to the box of the mask
+        t_enter, t_exit = ray_box_intervals(origins, directions, bounds)
+        t_start = np.maximum(t_enter[:, 0], 0.0)
+        t_stop = np.minimum(t_exit[:, 0], max_length)
+        rays = np.flatnonzero(t_start < t_stop)
+        if rays.size == 0:
+            continue
+
+        origin = origins[rays]
+        direction = directions[rays]
+        t_current = t_start[rays]
+        t_stop = t_stop[rays]
+
+        # Voxel holding the start point, the step direction and the distance to the next voxel boundaries
+        start = origin + direction * t_current[:, None]
+        voxel = np.clip(np.floor((start - box_min) / spacing).astype(np.int64), 0, shape - 1)
+        step = np.where(direction > 0, 1, -1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_delta = np.where(direction != 0, spacing / np.abs(direction), np.inf)
+            next_boundary = box_min + (voxel + (step > 0)) * spacing
+            t_next = np.where(direction != 0, (next_boundary - origin) / direction, np.inf)
+
+        ray_path = np.zeros(len(rays))
+        ray_entry = np.full(len(rays), np.inf)
+        ray_exit = np.full(len(rays), np.nan)
+
+        active = np.arange(len(rays))
+        while active.size:
+            current = voxel[active]
+            segment_end = np.minimum(t_next[active].min(axis=1), t_stop[active])
+
+            # Accumulate the segments that lie inside the structure
+            inside = mask[current[:, 2], current[:, 1], current[:, 0]]
+            inside_rays = active[inside]
+            ray_path[inside_rays] += segment_end[inside] - t_current[inside_rays]
+            ray_entry[inside_rays] = np.minimum(ray_entry[inside_rays], t_current[inside_rays])
+            ray_exit[inside_rays] = segment_end[inside]
+
+            # Step into the neighbouring voxel across the closest boundary
+            axis = np.argmin(t_next[active], axis=1)
+            t_current[active] = segment_end
+            voxel[active, axis] += step[active, axis]
+            t_next[active, axis] += t_delta[active, axis]
+
+            in_grid = np.all((voxel[active] >= 0) & (voxel[active] < shape), axis=1)
+            active = active[(segment_end < t_stop[active]) & in_grid]
+
+        was_hit = ray_path > 0
+        path_length[rays, index] = ray_path
+        entry[rays[was_hit], index] = ray_entry[was_hit]
+        exit[rays[was_hit], index] = ray_exit[was_hit]
+
+    return path_length > 0, path_length, entry, exit
+
+
+def load_voxel_masks(nifti_files, threshold=0.5):
+    """Return the voxel mask of each file, e.g. for trace_voxel_rays()."""
+    return [load_voxel_mask(nifti_file, threshold) for nifti_file in nifti_files]
+
+
+BEAM_SHAPES = ("line", "cylinder", "cone")
+
+
+def beam_overlap(start_point, end_point, radius, masks, shape="cylinder"):
+    """Return the volume (cc) and the fraction of each mask inside a beam going from start_point to end_point.
+
+    A "cylinder" beam has the given radius along its whole length, a "cone" beam has its apex at
+    start_point and the given radius at end_point. Only the voxels of the sub-grid covered by the
+    bounding box of the beam are tested, a voxel is inside when its center is.
+    """
+    if shape not in BEAM_SHAPES[1:]:
+        raise ValueError(f"Unknown beam shape {shape!r}, expected one of {BEAM_SHAPES[1:]}")
+    start = np.asarray(start_point, dtype=float)
+    end = np.asarray(end_point, dtype=float)
+    volume = np.zeros(len(masks))
+    fraction = np.zeros(len(masks))
+    length = np.linalg.norm(end - start)
+    if length == 0 or radius <= 0:
+        return volume, fraction
+    axis = (end - start) / length
+
+    # World box of the beam: the segment grown by the radius
+    beam_min = np.minimum(start, end) - radius
+    beam_max = np.maximum(start, end) + radius
+
+    for index, voxel_mask in enumerate(masks):
+        if voxel_mask is None:
+            continue
+        mask = voxel_mask.dense()
+        spacing = np.array(voxel_mask.spacing, dtype=float)
+        origin = np.array(voxel_mask.origin, dtype=float)
+        first = np.array(voxel_mask.extent[0::2])
+
+        # Voxel indices (x, y, z) of the cropped mask whose centers fall in the beam box
+        index_a = (beam_min - origin) / spacing - first
+        index_b = (beam_max - origin) / spacing - first
+        low = np.maximum(np.ceil(np.minimum(index_a, index_b)), 0).astype(int)
+        high = np.minimum(np.floor(np.maximum(index_a, index_b)), np.array(mask.shape[::-1]) - 1).astype(int)
+        if np.any(low > high):
+            continue
+        k, j, i = np.nonzero(mask[low[2]:high[2] + 1, low[1]:high[1] + 1, low[0]:high[0] + 1])
+        if k.size == 0:
+            continue
+
+        # Position of the voxel centers along the beam axis and squared distance to it
+        offsets = origin + (np.stack([i, j, k], axis=1) + low + first) * spacing - start
+        along = offsets @ axis
+        distance_sq = np.einsum("ij,ij->i", offsets, offsets) - along * along
+        beam_radius = radius if shape == "cylinder" else radius * along / length
+        inside = np.count_nonzero((along >= 0) & (along <= length) & (distance_sq <= beam_radius * beam_radius))
+
+        volume[index] = inside * abs(np.prod(spacing)) / 1000.0  # mm3 to cc
+        fraction[index] = inside / voxel_mask.voxel_count()
+    return volume, fraction
+
+
+# Masks of the current sweep, sent once to each worker process
+# Sweeps shorter than this many voxel steps (rays x longest side of each mask) run in this process:
+# each worker process imports Qt, VTK and this module, which takes seconds
+SWEEP_SETTINGS = {"min_parallel_steps": 200_000_000}
+
+_sweep_masks = None
+
+
+def _init_sweep_worker(masks):
+    """Keep the masks of the sweep in the worker process."""
+    global _sweep_masks
+    _sweep_masks = masks
+
+
+def _trace_sweep_rows(origin, azimuths, elevations, max_length, masks):
+    """Trace the rays of some elevation rows of a sweep, returning their path lengths (E x A x M)."""
+    grid_elevations, grid_azimuths = np.meshgrid(elevations, azimuths, indexing="ij")
+    directions = ray_directions(grid_azimuths.ravel(), grid_elevations.ravel())
+    origins = np.broadcast_to(np.asarray(origin, dtype=float), directions.shape)
+    _, path_length, _, _ = trace_voxel_rays(origins, directions, masks, max_length)
+    return path_length.reshape(len(elevations), len(azimuths), len(masks))
+
+
+def _sweep_rows(origin, azimuths, elevations, max_length):
+    """Trace some elevation rows of a sweep in a worker process."""
+    return _trace_sweep_rows(origin, azimuths, elevations, max_length, _sweep_masks)
+
+
+def sweep_beam_angles(origin, masks, azimuths, elevations, max_length=np.inf, max_workers=None, is_cancelled=None):
+    """Return the path length (E x A x M) of the rays from origin through M masks for every angle pair.
+
+    Angles are in degrees as in the ray simulation. The elevation rows are split across a pool
+    of processes (run in this process when there is a single worker or the sweep is small,
+    see SWEEP_SETTINGS). Returns None if is_cancelled() becomes true before the sweep is complete.
+    """
+    azimuths = np.asarray(azimuths, dtype=float)
+    elevations = np.asarray(elevations, dtype=float)
+    max_workers = max_workers or os.cpu_count() or 1
+    row_blocks = [rows for rows in np.array_split(np.arange(len(elevations)), max_workers * 4) if rows.size]
+    steps = len(azimuths) * len(elevations) * sum(max(mask.shape) for mask in masks if mask is not None)
+
+    path_length = np.zeros((len(elevations), len(azimuths), len(masks)))
+    if max_workers == 1 or steps < SWEEP_SETTINGS["min_parallel_steps"]:
+        for rows in row_blocks:
+            if is_cancelled is not None and is_cancelled():
+                return None
+            path_length[rows] = _trace_sweep_rows(origin, azimuths, elevations[rows], max_length, masks)
+        return path_length
+
+    # Spawned workers do not inherit the GUI threads and their locks
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers, mp_context=context,
+                             initializer=_init_sweep_worker, initargs=(masks,)) as executor:
+        futures = {
+            executor.submit(_sweep_rows, origin, azimuths, elevations[rows], max_length): rows
+            for rows in row_blocks
+        }
+        for future in as_completed(futures):
+            if is_cancelled is not None and is_cancelled():
+                for pending in futures:
+                    pending.cancel()
+                return None
+            path_length[futures[future]] = future.result()
+    return path_length
+
+
+class AngleSweep:
+    """Path lengths through each structure for a grid of beam angles from one origin."""
+
+    def __init__(self, origin, azimuths, elevations, files, path_length):
+        self.origin = tuple(origin)
+        self.azimuths = np.asarray(azimuths, dtype=float)
+        self.elevations = np.asarray(elevations, dtype=float)
+        self.files = list(files)
+        self.path_length = path_length  # Indexed [elevation, azimuth, file]
+
+    def crossed(self):
+        """Return the E x A x M boolean array of the structures crossed at each angle."""
+        return self.path_length > 0
+
+    def save(self, filename):
+        """Export the sweep as a NumPy archive (.npz) or as one CSV row per angle and structure."""
+        if filename.lower().endswith(".csv"):
+            with open(filename, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["azimuth", "elevation", "structure", "path_length_mm"])
+                for e, elevation in enumerate(self.elevations):
+                    for a, azimuth in enumerate(self.azimuths):
+                        for m, file_name in enumerate(self.files):
+                            writer.writerow([azimuth, elevation, file_name, f"{self.path_length[e, a, m]:.3f}"])
+        else:
+            np.savez_compressed(
+                filename, origin=self.origin, azimuths=self.azimuths, elevations=self.elevations,
+                files=np.array(self.files), path_length=self.path_length,
+            )
 
 
 def generate_random_color():
@@ -52,18 +1867,22 @@ def generate_random_color():
 class MainWindow(QMainWindow):
     """Main window for NIFTI file selection and rendering."""
 
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, render_window=None):
         super().__init__()
         self.folder_path = folder_path
-        self.nifti_files = [
-            os.path.join(folder_path, f)
-            for f in os.listdir(folder_path)
-            if f.endswith('.nii.gz')
-        ]
-        self.selected_files = []
-        self.render_window = None  
+        # The list comes from the cohort manifest, refreshed in the background
+        self.manifest = CohortManifest(folder_path)
+        self.nifti_files = self.manifest.files()
+        # Coming back from a render window, its files start checked and it shows the next selection
+        self.render_window = render_window
+        self.selected_files = list(render_window.nifti_files) if render_window is not None else []
         self.init_ui()
 
+        self.manifest_worker = LatestOnlyWorker()
+        self.manifest_worker.result_ready.connect(self.on_manifest_refreshed)
+        self.manifest_stage = "headers"
+        self.manifest_worker.submit(self.manifest.refresh)
+
 
     def init_ui(self):
         """Set up the user interface for file selection."""
@@ -74,12 +1893,21 @@ class MainWindow(QMainWindow):
         central_widget = QWidget()
         layout = QVBoxLayout()
 
+        # Filters on the patient and structure names
+        filter_layout = QHBoxLayout()
+        self.patient_filter = QLineEdit()
+        self.patient_filter.setPlaceholderText("Filter patients")
+        self.patient_filter.textChanged.connect(self.apply_filters)
+        self.structure_filter = QLineEdit()
+        self.structure_filter.setPlaceholderText("Filter structures")
+        self.structure_filter.textChanged.connect(self.apply_filters)
+        filter_layout.addWidget(self.patient_filter)
+        filter_layout.addWidget(self.structure_filter)
+        layout.addLayout(filter_layout)
+
         # List of NIFTI files with checkboxes
         self.file_list = QListWidget()
-        for nifti_file in self.nifti_files:
-            item = QListWidgetItem(os.path.basename(nifti_file))
-            item.setCheckState(0)
-            self.file_list.addItem(item)
+        self.populate_file_list()
         layout.addWidget(self.file_list)
 
         # Buttons for interaction
@@ -96,24 +1924,95 @@ class MainWindow(QMainWindow):
         button_layout.addWidget(self.stereo_button)
         layout.addLayout(button_layout)
 
+        # Extract all surfaces from one fused label map instead of contouring each file
+        self.fused_labels_checkbox = QCheckBox("Fused label extraction")
+        layout.addWidget(self.fused_labels_checkbox)
+
         # Finalize layout
         central_widget.setLayout(layout)
         self.setCentralWidget(central_widget)
 
 
-    def render_selected_files(self):
-        """Render the selected files based on the stereo rendering state."""
-        self.selected_files = [
-            self.nifti_files[i]
+    def populate_file_list(self):
+        """Fill the list from the manifest, keeping the checked files checked (the selected ones if it was empty)."""
+        checked = set(self.checked_files() if self.file_list.count() else self.selected_files)
+        several_patients = len(self.manifest.patients()) > 1
+        self.file_list.clear()
+        for nifti_file in self.nifti_files:
+            entry = self.manifest.get(nifti_file)
+            if entry is None:
+                continue  # Removed by the background refresh, the list is filled again once it is done
+            name = os.path.basename(nifti_file)
+            item = QListWidgetItem(f"{entry['patient']} / {name}" if several_patients else name)
+            item.setData(Qt.UserRole, nifti_file)
+            # The filters use this copy, the manifest may change on the refresh thread meanwhile
+            item.setData(Qt.UserRole + 1, (entry["patient"].lower(), entry["structure"].lower()))
+            item.setCheckState(Qt.Checked if nifti_file in checked else Qt.Unchecked)
+            voxel_count = entry["voxel_count"]
+            item.setToolTip(
+                f"Dims: {entry['dims']}, spacing: {[round(value, 3) for value in entry['spacing']]}\n"
+                f"Voxels: {'...' if voxel_count is None else voxel_count}, size: {entry['size'] / 1e6:.1f} MB"
+            )
+            self.file_list.addItem(item)
+        self.apply_filters()
+
+
+    def apply_filters(self):
+        """Hide the files whose patient or structure does not match the filters."""
+        patient_filter = self.patient_filter.text().lower()
+        structure_filter = self.structure_filter.text().lower()
+        for i in range(self.file_list.count()):
+            item = self.file_list.item(i)
+            patient, structure = item.data(Qt.UserRole + 1)
+            item.setHidden(patient_filter not in patient or structure_filter not in structure)
+
+
+    def checked_files(self):
+        """Return the files checked in the list."""
+        return [
+            self.file_list.item(i).data(Qt.UserRole)
             for i in range(self.file_list.count())
             if self.file_list.item(i).checkState()
         ]
 
+
+    def on_manifest_refreshed(self, generation, changed):
+        """Show the refreshed manifest, then fill in the voxel counts in the background."""
+        if generation != self.manifest_worker.generation:
+            return  # Reported after the window was closed
+        if changed:
+            self.nifti_files = self.manifest.files()
+            self.populate_file_list()
+        if self.manifest_stage == "headers":
+            self.manifest_stage = "voxels"
+            self.manifest_worker.submit(self.manifest.count_voxels)
+
+
+    def closeEvent(self, event):
+        """Stop the manifest refresh when the window is closed, and the hidden render window when quitting."""
+        self.manifest_worker.shutdown()
+        if self.render_window is not None and not self.render_window.isVisible():
+            self.render_window.close()
+        super().closeEvent(event)
+
+
+    def render_selected_files(self):
+        """Render the selected files based on the stereo rendering state."""
+        self.selected_files = self.checked_files()
+
         if not self.selected_files:
             return 
 
-        # Initialize
-        self.render_window = RenderWindow(self.selected_files)
+        # Initialize, or only load and drop the structures that changed in the window we came back from
+        if self.render_window is None:
+            self.render_window = RenderWindow(
+                self.selected_files, fused_labels=self.fused_labels_checkbox.isChecked(),
+                cohort_root=self.folder_path,
+            )
+        else:
+            self.render_window.set_structures(
+                self.selected_files, fused_labels=self.fused_labels_checkbox.isChecked()
+            )
         render_window = self.render_window.vtk_widget.GetRenderWindow()
 
         # Check if stereo rendering is enabled or not and change text accordingly 
@@ -159,18 +2058,38 @@ class MainWindow(QMainWindow):
 class RenderWindow(QWidget):
     """Rendering window for 3D visualization of NIFTI files."""
 
-    def __init__(self, nifti_files):
+    def __init__(self, nifti_files, fused_labels=False, cohort_root=None):
         super().__init__()
         self.nifti_files = nifti_files
+        self.fused_labels = fused_labels
+        # Folder the selector was opened on, to go back to it
+        self.cohort_root = cohort_root
         self.labels = [] 
+        # Label of each pickable prop (surfaces and volumes), for constant time lookups
+        self.actor_labels = {}
+        self.hovered_label = None
+        # Label map of the combined volume and the surface actor of each of its labels
+        self.volume_label_map = None
+        self.volume_label_actors = []
         self.text_actor = vtk.vtkTextActor() 
         self.default_view_position = (-1000, -1000, 400) 
         # Default focal point is the center of the brain
         self.default_view_focal_point = self.get_center_of_brain()
         self.default_view_up = (0, 0, 1)
-        self.intersection_markers = []
+        self.intersection_points = []
         self.ray_direction = (1, 0, 0) 
         self.marker_radius = 3.0
+
+        # Renders and UI label updates are coalesced and flushed at most once per frame
+        self.render_pending = False
+        self.ray_update_pending = False
+        self.camera_labels_pending = False
+        self.pending_label_texts = {}
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.setInterval(FRAME_INTERVAL_MS)
+        self.frame_timer.timeout.connect(self.flush_frame)
+
         self.init_ui()
 
     def init_ui(self):
@@ -181,10 +2100,30 @@ class RenderWindow(QWidget):
 
         # QVTKRenderWindowInteractor for embedding VTK in PyQt
         self.vtk_widget = QVTKRenderWindowInteractor(self)
-        self.vtk_widget.SetInteractorStyle(vtk.vtkInteractorStyleTrackballCamera())
+        self.interactor_style = vtk.vtkInteractorStyleTrackballCamera()
+        self.vtk_widget.SetInteractorStyle(self.interactor_style)
         self.vtk_renderer = vtk.vtkRenderer()
         self.vtk_widget.GetRenderWindow().AddRenderer(self.vtk_renderer)
 
+        # Levels of detail: full resolution mesh of each surface actor and one mapper per level,
+        # volumes have a full resolution and a downsampled mapper
+        self.actor_meshes = {}
+        self.lod_mappers = {}
+        # Memory held by the levels of detail of each surface actor
+        self.mesh_bytes = {}
+        self.lod_level = 0
+        self.interactive_lod_level = 1  # Adapted to the target frame rate, kept between interactions
+        self.interacting = False
+        # Composite mode: the surface actors are handles, one composite actor draws them all
+        self.composite_surfaces = None
+        if RENDER_SETTINGS["surfaces"] == "composite":
+            self.composite_surfaces = CompositeSurfaces(1 + len(LOD_SETTINGS["reductions"]))
+            self.vtk_renderer.AddActor(self.composite_surfaces.actor)
+        self.vtk_widget.GetRenderWindow().GetInteractor().SetDesiredUpdateRate(LOD_SETTINGS["target_fps"])
+        self.interactor_style.AddObserver("StartInteractionEvent", self.on_interaction_start)
+        self.interactor_style.AddObserver("EndInteractionEvent", self.on_interaction_end)
+        self.vtk_renderer.AddObserver("EndEvent", self.on_interactive_frame)
+
         # Text actor for displaying the label
         self.text_actor.GetTextProperty().SetColor(1.0, 1.0, 1.0)  # White text
         self.text_actor.GetTextProperty().SetFontSize(20)
@@ -202,12 +2141,12 @@ class RenderWindow(QWidget):
         self.is_full_screen = False
 
         # Add axes
-        axes = vtk.vtkCubeAxesActor()
+        self.cube_axes = vtk.vtkCubeAxesActor()
         bounds = self.get_bounds_from_first_nifti()
-        axes.SetBounds(bounds)
-        axes.SetCamera(self.vtk_renderer.GetActiveCamera())
-        axes.SetFlyModeToOuterEdges()
-        self.vtk_renderer.AddViewProp(axes)
+        self.cube_axes.SetBounds(bounds)
+        self.cube_axes.SetCamera(self.vtk_renderer.GetActiveCamera())
+        self.cube_axes.SetFlyModeToOuterEdges()
+        self.vtk_renderer.AddViewProp(self.cube_axes)
 
         # Layout for the camera information
         info_layout = QVBoxLayout()
@@ -270,6 +2209,27 @@ class RenderWindow(QWidget):
         self.elevation_label = QLabel("Elevation: 30°")
         self.azimuth_label = QLabel("Azimuth: 45°")
 
+        # Ray/organ intersection engine: surface meshes or voxel traversal of the masks
+        self.engine_label = QLabel("Engine:")
+        self.engine_combo = QComboBox()
+        self.engine_combo.addItem("Mesh", "mesh")
+        self.engine_combo.addItem("Voxel", "voxel")
+        self.engine_combo.currentIndexChanged.connect(self.on_engine_changed)
+
+        # Beam shape: thin line, or a cylinder/cone of the chosen radius measured on the voxel masks
+        self.beam_label = QLabel("Beam:")
+        self.beam_combo = QComboBox()
+        self.beam_combo.addItem("Line", "line")
+        self.beam_combo.addItem("Cylinder", "cylinder")
+        self.beam_combo.addItem("Cone", "cone")
+        self.beam_combo.currentIndexChanged.connect(self.on_beam_shape_changed)
+
+        # Evaluate every beam angle from the current origin
+        self.sweep_button = QPushButton("Angle sweep...")
+        self.sweep_button.clicked.connect(self.open_angle_sweep)
+        self.sweep_worker = LatestOnlyWorker()
+        self.sweep_dialog = None
+
         self.x_slider.hide()
         self.y_slider.hide()
         self.z_slider.hide()
@@ -284,8 +2244,18 @@ class RenderWindow(QWidget):
         self.azimuth_label.hide()
         self.elevation_label.hide()
         self.radius_label.hide()
+        self.engine_label.hide()
+        self.engine_combo.hide()
+        self.beam_label.hide()
+        self.beam_combo.hide()
+        self.sweep_button.hide()
 
         # Add the labels and sliders to the sliders layout
+        sliders_layout.addWidget(self.engine_label)
+        sliders_layout.addWidget(self.engine_combo)
+        sliders_layout.addWidget(self.beam_label)
+        sliders_layout.addWidget(self.beam_combo)
+        sliders_layout.addWidget(self.sweep_button)
         sliders_layout.addWidget(self.x_label)
         sliders_layout.addWidget(self.x_slider)
         sliders_layout.addWidget(self.y_label)
@@ -305,6 +2275,20 @@ class RenderWindow(QWidget):
 
         # Add sliders widget to the main layout
         main_layout.addWidget(sliders_widget)
+
+        # Progress of the structure loading, with a button to cancel it
+        loading_layout = QHBoxLayout()
+        self.loading_progress = QProgressBar()
+        self.loading_progress.setFormat("Loading structures: %v / %m")
+        loading_layout.addWidget(self.loading_progress)
+        self.cancel_loading_button = QPushButton("Cancel loading")
+        self.cancel_loading_button.clicked.connect(self.cancel_loading)
+        loading_layout.addWidget(self.cancel_loading_button)
+        # Memory held by the images, meshes and textures of the structures
+        self.memory_label = QLabel()
+        loading_layout.addWidget(self.memory_label)
+        main_layout.addLayout(loading_layout)
+
         self.setLayout(main_layout)
 
         # Initialize the rendering for surfaces and volumes
@@ -314,36 +2298,236 @@ class RenderWindow(QWidget):
         self.ray_simulation_enabled = False
         self.ray_origin = (0, 300, 250) 
         self.ray_length = 500  
-
-        self.ray_actors = []
-
-        # Initialize the surface rendering actors
-        for nifti_file in self.nifti_files:
-            color = generate_random_color()
-            actor, label = load_nifti_as_actor(
-                nifti_file, threshold=0.5, color=color, label=os.path.basename(nifti_file)
-            )
-            self.vtk_renderer.AddActor(actor)
-            self.surface_actors.append(actor)
-            self.labels.append((actor, label))
-
-        # Initialize the volume rendering actors
-        for nifti_file in self.nifti_files:
-            volume_actor = self.create_volume_actor(nifti_file)
-            self.volume_actors.append(volume_actor)
+        self.ray_engine = "mesh"
+        self.beam_shape = "line"
+
+        # Ray actor, created once and whose end points are updated in place
+        self.ray_source = vtk.vtkLineSource()
+        ray_mapper = vtk.vtkPolyDataMapper()
+        ray_mapper.SetInputConnection(self.ray_source.GetOutputPort())
+        self.ray_actor = vtk.vtkActor()
+        self.ray_actor.SetMapper(ray_mapper)
+        self.ray_actor.GetProperty().SetColor(1.0, 0.0, 0.0)
+        self.ray_actor.VisibilityOff()
+        self.vtk_renderer.AddActor(self.ray_actor)
+
+        # Thick beam around the ray, a tube for the cylinder and a cone source for the cone
+        self.beam_tube = vtk.vtkTubeFilter()
+        self.beam_tube.SetInputConnection(self.ray_source.GetOutputPort())
+        self.beam_tube.SetNumberOfSides(32)
+        self.beam_tube.CappingOn()
+        self.beam_cone = vtk.vtkConeSource()
+        self.beam_cone.SetResolution(32)
+        self.beam_mapper = vtk.vtkPolyDataMapper()
+        self.beam_mapper.SetInputConnection(self.beam_tube.GetOutputPort())
+        self.beam_actor = vtk.vtkActor()
+        self.beam_actor.SetMapper(self.beam_mapper)
+        self.beam_actor.GetProperty().SetColor(1.0, 0.0, 0.0)
+        self.beam_actor.GetProperty().SetOpacity(0.25)
+        self.beam_actor.VisibilityOff()
+        self.vtk_renderer.AddActor(self.beam_actor)
+
+        # Intersection markers, one sphere glyph per intersection point, all in a single actor
+        self.marker_points = vtk.vtkPoints()
+        marker_poly_data = vtk.vtkPolyData()
+        marker_poly_data.SetPoints(self.marker_points)
+        marker_sphere = vtk.vtkSphereSource()
+        marker_sphere.SetRadius(1.0)
+        self.marker_glyph = vtk.vtkGlyph3D()
+        self.marker_glyph.SetInputData(marker_poly_data)
+        self.marker_glyph.SetSourceConnection(marker_sphere.GetOutputPort())
+        self.marker_glyph.SetScaleModeToDataScalingOff()
+        self.marker_glyph.OrientOff()
+        self.marker_glyph.SetScaleFactor(self.marker_radius)
+        marker_mapper = vtk.vtkPolyDataMapper()
+        marker_mapper.SetInputConnection(self.marker_glyph.GetOutputPort())
+        self.marker_actor = vtk.vtkActor()
+        self.marker_actor.SetMapper(marker_mapper)
+        self.marker_actor.GetProperty().SetColor(0.0, 1.0, 0.0)  # Green markers
+        self.vtk_renderer.AddActor(self.marker_actor)
+
+        # File of each surface actor (actors are added in loading order) and surface actor of each file
+        self.actor_files = {}
+        self.structure_actors = {}
+        # Ray intersection locator of each surface actor, built on the first ray query (worker thread only)
+        self.ray_locators = {}
+        # Ray intersections are computed on a worker thread, only the latest query is applied
+        self.intersection_worker = LatestOnlyWorker()
+        self.intersection_worker.result_ready.connect(self.on_intersections_ready)
+        self.intersection_generation = 0
+        # Triangle chunks of each surface actor for batch ray casting, built on the first batch
+        self.ray_cast_meshes = {}
+        # Voxel masks of the loaded files for the voxel engine, read on first use
+        self.voxel_masks = {}
+        self.voxel_masks_lock = threading.Lock()
+        # Volume actors are built the first time volume rendering is turned on
+        self.volume_actors_stale = True
+        # Structure of each per file volume and the other way round
+        self.volume_structures = {}
+        self.structure_volumes = {}
+        # Volumes are kept while they fit in the budget, the least recently shown ones are released first
+        # and rebuilt when shown again
+        self.volume_budget = MemoryBudget(VOLUME_SETTINGS["budget_bytes"])
+        # Volumes whose textures were uploaded to the GPU
+        self.uploaded_volumes = set()
 
         # Add mouse move functionality
+        # Picker reused by hover and click, restricted to the structures
+        self.picker = vtk.vtkPropPicker()
+        self.picker.PickFromListOn()
         self.setup_mouse_move()
 
-        # Set the camera
+        # Set the camera, the bounds come from the header index since the structures are not loaded yet
         self.reset_camera_to_default()
         self.observe_camera()
-        self.vtk_renderer.ResetCamera()  
+        self.vtk_renderer.ResetCamera(self.get_bounds_from_first_nifti())
 
         # Initialize and start interaction
         self.vtk_widget.Initialize()
         self.vtk_widget.Start()
 
+        self.structure_loader = None
+        self.start_loading(self.nifti_files)
+
+
+    ####################    STRUCTURE LOADING    ###################
+
+    def start_loading(self, nifti_files):
+        """Read and contour structures in the background, each one is added as soon as it is ready."""
+        if not nifti_files:
+            self.finish_loading()
+            return
+        loader_class = FusedStructureLoader if self.fused_labels else StructureLoader
+        self.structure_loader = loader_class(nifti_files, threshold=0.5)
+        self.structure_loader.structure_loaded.connect(self.on_structure_loaded)
+        self.structure_loader.structure_failed.connect(self.on_structure_failed)
+        self.structure_loader.progress.connect(self.on_loading_progress)
+        self.structure_loader.finished.connect(self.on_loading_finished)
+        self.loading_progress.setRange(0, len(nifti_files))
+        self.loading_progress.setValue(0)
+        self.loading_progress.show()
+        self.cancel_loading_button.show()
+        self.structure_loader.start()
+
+    def set_structures(self, nifti_files, fused_labels=False):
+        """Show a new selection of files: only the structures added to it are loaded, only the removed ones
+        are dropped. The camera and the opacity and visibility of the kept structures do not change."""
+        if self.structure_loader is not None:
+            self.structure_loader.cancel()
+        self.nifti_files = list(nifti_files)
+        self.fused_labels = fused_labels
+        for actor in [actor for actor in self.surface_actors if self.actor_files[actor] not in self.nifti_files]:
+            self.remove_structure(actor)
+        self.populate_file_list()
+        self.update_selection_bounds()
+        # The volumes are updated once the added structures are loaded
+        self.start_loading([nifti_file for nifti_file in self.nifti_files if nifti_file not in self.structure_actors])
+
+        if self.ray_simulation_enabled:
+            self.request_ray_update()
+        self.update_memory_readout()
+        self.request_render()
+
+    def remove_structure(self, actor):
+        """Remove a structure from the scene, with its volume, levels of detail and ray query caches."""
+        nifti_file = self.actor_files.pop(actor)
+        del self.structure_actors[nifti_file]
+        self.vtk_renderer.RemoveActor(actor)
+        if self.composite_surfaces is not None:
+            self.composite_surfaces.remove(actor)
+        self.surface_actors.remove(actor)
+        self.labels = [(other, label) for other, label in self.labels if other is not actor]
+        if self.hovered_label == self.actor_labels.pop(actor):
+            self.hovered_label = None
+            self.text_actor.SetInput("")
+        self.picker.DeletePickList(actor)
+        for cache in (self.actor_meshes, self.lod_mappers, self.mesh_bytes, self.ray_locators, self.ray_cast_meshes):
+            cache.pop(actor, None)
+        with self.voxel_masks_lock:
+            self.voxel_masks.pop(nifti_file, None)
+
+        # The combined volume is rebuilt without the structure (hidden until then), a per file volume is dropped
+        if self.volume_label_map is not None and actor in self.volume_label_actors:
+            set_label_appearance(
+                self.volume_actors[0], self.volume_label_actors.index(actor) + 1, (0.0, 0.0, 0.0), 0.0
+            )
+        if actor in self.structure_volumes:
+            self.release_volume_actors([self.structure_volumes[actor]])
+        self.volume_actors_stale = True
+
+    def on_structure_loaded(self, nifti_file, result):
+        """Add the surface and volume actors of a structure that finished loading."""
+        if nifti_file not in self.nifti_files or nifti_file in self.structure_actors:
+            return  # Left over from a selection that changed since
+        levels = result
+        poly_data = levels[0]
+        actor = create_surface_actor(poly_data, generate_random_color())
+        label = os.path.basename(nifti_file)
+        # The full resolution mesh is used for ray queries, the levels of detail only for drawing
+        self.actor_meshes[actor] = poly_data
+        self.mesh_bytes[actor] = sum(data_nbytes(level) for level in levels)
+        if self.composite_surfaces is not None:
+            self.composite_surfaces.add(actor, levels)
+        else:
+            self.lod_mappers[actor] = [actor.GetMapper()] + [create_surface_mapper(level) for level in levels[1:]]
+        self.surface_actors.append(actor)
+        self.labels.append((actor, label))
+        self.actor_labels[actor] = label
+        self.picker.AddPickList(actor)
+        self.actor_files[actor] = nifti_file
+        self.structure_actors[nifti_file] = actor
+
+        # Volumes are only rebuilt if volume rendering is in use. A per file volume is built right away,
+        # the combined volume once every structure is loaded
+        self.volume_actors_stale = True
+        if not self.is_volume_rendering:
+            if self.composite_surfaces is None:
+                self.vtk_renderer.AddActor(actor)
+        elif VOLUME_SETTINGS["mode"] == "per_file":
+            self.show_volume_actors()
+
+        # Take the new structure into account in the ray simulation
+        if self.ray_simulation_enabled:
+            self.request_ray_update()
+        self.update_memory_readout()
+        self.request_render()
+
+    def on_structure_failed(self, nifti_file, error):
+        """Report a structure that could not be loaded."""
+        print(f"Could not load {os.path.basename(nifti_file)}: {error}")
+
+    def on_loading_progress(self, done_count, total_count):
+        """Update the loading progress bar."""
+        if self.sender() is self.structure_loader:
+            self.loading_progress.setValue(done_count)
+
+    def on_loading_finished(self):
+        """Finish loading once every structure of the current selection is loaded."""
+        if self.sender() is self.structure_loader:  # Not the loader of a previous selection
+            self.finish_loading()
+
+    def finish_loading(self):
+        """Hide the loading controls and build the volumes that waited for the structures."""
+        self.loading_progress.hide()
+        self.cancel_loading_button.hide()
+        if self.is_volume_rendering and self.volume_actors_stale:
+            self.show_volume_actors()
+            self.request_render()
+
+    def cancel_loading(self):
+        """Stop loading the structures that are not loaded yet."""
+        if self.structure_loader is not None:
+            self.structure_loader.cancel()
+        self.finish_loading()
+
+    def closeEvent(self, event):
+        """Stop the background loading and queries when the window is closed."""
+        if self.structure_loader is not None:
+            self.structure_loader.cancel()
+        self.intersection_worker.shutdown()
+        self.sweep_worker.shutdown()
+        super().closeEvent(event)
+
 
     ####################    SLIDERS CREATION    ###################
    
@@ -488,6 +2672,11 @@ class RenderWindow(QWidget):
             self.azimuth_label.show()
             self.elevation_label.show()
             self.radius_label.show()
+            self.engine_label.show()
+            self.engine_combo.show()
+            self.beam_label.show()
+            self.beam_combo.show()
+            self.sweep_button.show()
             self.ray_button.setText("Disable Ray Simulation")
 
             # Ensure ray is created/reset when enabling ray simulation
@@ -507,16 +2696,21 @@ class RenderWindow(QWidget):
             self.azimuth_label.hide()
             self.elevation_label.hide()
             self.radius_label.hide()
+            self.engine_label.hide()
+            self.engine_combo.hide()
+            self.beam_label.hide()
+            self.beam_combo.hide()
+            self.sweep_button.hide()
             self.ray_button.setText("Activate Ray Simulation")
 
-            # Remove ray when disabling ray simulation
-            for ray_actor in self.ray_actors:
-                self.vtk_renderer.RemoveActor(ray_actor)
-            self.ray_actors = []
+            # Hide ray when disabling ray simulation, a running query is ignored
+            self.ray_actor.VisibilityOff()
+            self.beam_actor.VisibilityOff()
+            self.intersection_worker.cancel()
 
             self.remove_markers()
 
-        self.vtk_widget.GetRenderWindow().Render()
+        self.request_render()
 
 
     def create_ray(self):
@@ -551,40 +2745,23 @@ class RenderWindow(QWidget):
             self.ray_origin[2] + ray_direction[2] * self.ray_length
         )
 
-        # Create a VTK Line Source for visualization
-        line_source = vtk.vtkLineSource()
-        line_source.SetPoint1(self.ray_origin)
-        line_source.SetPoint2(end_point)
-
-        # Mapper and actor setup for visualization
-        mapper = vtk.vtkPolyDataMapper()
-        mapper.SetInputConnection(line_source.GetOutputPort())
-
-        actor = vtk.vtkActor()
-        actor.SetMapper(mapper)
-        actor.GetProperty().SetColor(1.0, 0.0, 0.0)
-
-        # Remove any existing ray actor (if present)
-        for ray_actor in self.ray_actors:
-            self.vtk_renderer.RemoveActor(ray_actor)
-
-        # Add the new ray actor to the scene
-        self.ray_actors = [actor]
-        self.vtk_renderer.AddActor(actor)
+        # Move the ray actor to the new end points
+        self.ray_source.SetPoint1(self.ray_origin)
+        self.ray_source.SetPoint2(end_point)
+        self.ray_actor.VisibilityOn()
+        self.update_beam_actor(self.ray_origin, end_point)
 
         # Check for intersections with loaded files
         self.check_intersections(self.ray_origin, end_point)
 
         # Render the updated scene
-        self.vtk_widget.GetRenderWindow().Render()
+        self.request_render()
 
 
     def remove_markers(self):
         """Remove all intersection markers from the scene."""
-        for marker in self.intersection_markers:
-            self.vtk_renderer.RemoveActor(marker)
-        self.intersection_markers.clear() 
-        self.vtk_widget.GetRenderWindow().Render()
+        self.set_intersection_markers([])
+        self.request_render()
 
 
     def populate_file_list(self):
@@ -606,54 +2783,265 @@ class RenderWindow(QWidget):
 
 
     def check_intersections(self, start_point, end_point):
-        """Check if the ray intersects with any loaded 3D objects."""
+        """Check if the ray intersects with any loaded 3D objects (the result is applied asynchronously)."""
         if not self.nifti_files:
             return  # No files loaded
 
-        # Remove previous intersection markers
-        for marker in self.intersection_markers:
-            self.vtk_renderer.RemoveActor(marker)
-        self.intersection_markers = []
+        if self.beam_shape != "line":
+            loaded_files = [self.actor_files[actor] for actor in self.surface_actors]
+            self.intersection_generation = self.intersection_worker.submit(
+                self.compute_beam_overlap, start_point, end_point, self.marker_radius, self.beam_shape, loaded_files
+            )
+            return
 
+        if self.ray_engine == "voxel":
+            loaded_files = [self.actor_files[actor] for actor in self.surface_actors]
+            self.intersection_generation = self.intersection_worker.submit(
+                self.compute_voxel_intersections, start_point, end_point, loaded_files
+            )
+            return
+
+        # Snapshot of the surfaces, the query itself runs on the worker thread
+        surfaces = [
+            (actor, self.actor_files[actor], self.actor_meshes[actor])
+            for actor in self.surface_actors
+        ]
+        self.intersection_generation = self.intersection_worker.submit(
+            self.compute_intersections, start_point, end_point, surfaces
+        )
+
+
+    def compute_intersections(self, start_point, end_point, surfaces, is_outdated):
+        """Return the files crossed by the ray segment and the intersection points (runs on the worker thread)."""
         intersected_files = []  # Store the names of files that the ray intersects
+        intersection_points = []  # Points where the ray crosses a surface
 
-        # Create a ray intersection checker
-        obb_tree = vtk.vtkOBBTree()
-        obb_tree.SetMaxLevel(10)
+        # Broad phase: only the surfaces whose bounding box is crossed get an exact test
+        bounds = [poly_data.GetBounds() for _, _, poly_data in surfaces]
+        hit_boxes = segment_hits_boxes(start_point, end_point, bounds)
 
-        for file_actor, file_name in zip(self.surface_actors, self.nifti_files):  # Assuming actors and filenames are paired
-            poly_data = file_actor.GetMapper().GetInput()
-            obb_tree.SetDataSet(poly_data)
-            obb_tree.BuildLocator()
+        for (file_actor, file_name, poly_data), hit in zip(surfaces, hit_boxes):
+            if not hit:
+                continue
+            # A newer ray is waiting, this result would be dropped anyway
+            if is_outdated():
+                return None
+            obb_tree = self.get_ray_locator(file_actor, poly_data)
 
             # Compute intersection points
-            intersection_points = vtk.vtkPoints()
-            code = obb_tree.IntersectWithLine(start_point, end_point, intersection_points, None)
+            points = vtk.vtkPoints()
+            code = obb_tree.IntersectWithLine(start_point, end_point, points, None)
 
             if code == 1:  # Intersection found
                 intersected_files.append(file_name)  # Add the file name to the list
-                for i in range(intersection_points.GetNumberOfPoints()):
-                    point = intersection_points.GetPoint(i)
-                    # print(f"Intersection at: {point}")
+                for i in range(points.GetNumberOfPoints()):
+                    intersection_points.append(points.GetPoint(i))
+
+        return intersected_files, intersection_points, {}
+
+
+    def compute_voxel_intersections(self, start_point, end_point, files, is_outdated):
+        """Walk the ray segment through the voxel masks, returning the crossed files, entry/exit points and path lengths."""
+        masks = self.get_voxel_masks(files)
+        if is_outdated():
+            return None
+
+        start = np.asarray(start_point, dtype=float)
+        direction = np.asarray(end_point, dtype=float) - start
+        length = np.linalg.norm(direction)
+        if length == 0:
+            return [], [], {}
+        hit, path_length, entry, exit = trace_voxel_rays([start], [direction], masks, max_length=length)
+
+        intersected_files = []
+        intersection_points = []
+        details = {}
+        unit_direction = direction / length
+        for index, file_name in enumerate(files):
+            if hit[0, index]:
+                intersected_files.append(file_name)
+                intersection_points.append(tuple(start + unit_direction * entry[0, index]))
+                intersection_points.append(tuple(start + unit_direction * exit[0, index]))
+                details[file_name] = f"{path_length[0, index]:.1f} mm"
+        return intersected_files, intersection_points, details
+
+
+    def compute_beam_overlap(self, start_point, end_point, radius, shape, files, is_outdated):
+        """Measure the volume of each structure inside the thick beam (runs on the worker thread)."""
+        masks = self.get_voxel_masks(files)
+        if is_outdated():
+            return None
+
+        volume, fraction = beam_overlap(start_point, end_point, radius, masks, shape)
+        intersected_files = []
+        details = {}
+        for index, file_name in enumerate(files):
+            if volume[index] > 0:
+                intersected_files.append(file_name)
+                details[file_name] = f"{volume[index]:.2f} cc, {fraction[index]:.1%}"
+        return intersected_files, [], details
+
+
+    def get_voxel_masks(self, files):
+        """Return the voxel mask of each file, reading the missing ones in parallel.
+
+        The lock is not held while reading, so other threads only wait for the dict itself.
+        """
+        with self.voxel_masks_lock:
+            masks = {file_name: self.voxel_masks[file_name] for file_name in files if file_name in self.voxel_masks}
+        missing = [file_name for file_name in files if file_name not in masks]
+        if missing:
+            with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+                loaded = list(executor.map(load_voxel_mask, missing))
+            with self.voxel_masks_lock:
+                # Another thread may have read the same masks meanwhile, the first one stored is kept
+                for file_name, voxel_mask in zip(missing, loaded):
+                    masks[file_name] = self.voxel_masks.setdefault(file_name, voxel_mask)
+        return [masks[file_name] for file_name in files]
+
+
+    def trace_voxel_ray_batch(self, origins, directions, max_length=np.inf):
+        """Walk many rays through the voxel masks of the loaded structures (see trace_voxel_rays).
+
+        Returns (files, hit, path_length, entry, exit) where the N x M arrays follow the order of files.
+        """
+        files = [self.actor_files[actor] for actor in self.surface_actors]
+        hit, path_length, entry, exit = trace_voxel_rays(
+            origins, directions, self.get_voxel_masks(files), max_length=max_length
+        )
+        return files, hit, path_length, entry, exit
+
+
+    def on_intersections_ready(self, generation, result):
+        """Apply the result of the latest intersection query."""
+        if generation != self.intersection_generation or result is None or not self.ray_simulation_enabled:
+            return
+        intersected_files, intersection_points, details = result
 
-                    # Visualize intersection points
-                    self.add_intersection_marker(point,radius=self.marker_radius)
+        # Visualize intersection points
+        self.set_intersection_markers(intersection_points)
 
         # Update the file list with highlighted intersected files
-        self.highlight_intersected_files(intersected_files)
+        self.highlight_intersected_files(intersected_files, details)
+        self.request_render()
+
+
+    def on_engine_changed(self, index):
+        """Switch the ray intersection engine."""
+        self.ray_engine = self.engine_combo.itemData(index)
+        self.request_ray_update()
+
 
-        self.vtk_widget.GetRenderWindow().Render()
+    def on_beam_shape_changed(self, index):
+        """Switch between the thin ray and a thick beam."""
+        self.beam_shape = self.beam_combo.itemData(index)
+        self.request_ray_update()
 
 
-    def highlight_intersected_files(self, intersected_files):
-        """Highlight the intersected files in the file list widget."""
+    def open_angle_sweep(self):
+        """Show the angle sweep dialog."""
+        if self.sweep_dialog is None:
+            self.sweep_dialog = AngleSweepDialog(self)
+            self.sweep_worker.result_ready.connect(self.sweep_dialog.on_sweep_ready)
+        self.sweep_dialog.show()
+        self.sweep_dialog.raise_()
+
+
+    def run_angle_sweep(self, azimuths, elevations):
+        """Start a sweep of the beam angles from the current ray origin, the result goes to the sweep dialog."""
+        files = [self.actor_files[actor] for actor in self.surface_actors]
+        return self.sweep_worker.submit(
+            self.compute_angle_sweep, self.ray_origin, azimuths, elevations, self.ray_length, files
+        )
+
+
+    def compute_angle_sweep(self, origin, azimuths, elevations, max_length, files, is_outdated):
+        """Trace the rays of every angle through the voxel masks (runs on the sweep worker thread)."""
+        masks = self.get_voxel_masks(files)
+        if is_outdated():
+            return None
+        path_length = sweep_beam_angles(origin, masks, azimuths, elevations, max_length, is_cancelled=is_outdated)
+        if path_length is None:
+            return None
+        return AngleSweep(origin, azimuths, elevations, files, path_length)
+
+
+    def set_ray_angles(self, azimuth, elevation):
+        """Point the ray at the given angles by moving the sliders."""
+        self.azimuth_slider.findChild(QSlider).setValue(int(round(azimuth)))
+        self.elevation_slider.findChild(QSlider).setValue(int(round(elevation)))
+
+
+    def update_beam_actor(self, start_point, end_point):
+        """Shape the beam actor around the ray, or hide it for a thin ray."""
+        if self.beam_shape == "line":
+            self.beam_actor.VisibilityOff()
+            return
+        if self.beam_shape == "cylinder":
+            self.beam_tube.SetRadius(self.marker_radius)
+            self.beam_mapper.SetInputConnection(self.beam_tube.GetOutputPort())
+        else:
+            # The cone source points its apex along its direction, the apex is at the ray origin
+            start = np.asarray(start_point, dtype=float)
+            end = np.asarray(end_point, dtype=float)
+            self.beam_cone.SetCenter(*((start + end) / 2))
+            self.beam_cone.SetDirection(*(start - end))
+            self.beam_cone.SetHeight(np.linalg.norm(end - start))
+            self.beam_cone.SetRadius(self.marker_radius)
+            self.beam_mapper.SetInputConnection(self.beam_cone.GetOutputPort())
+        self.beam_actor.VisibilityOn()
+
+
+    def cast_ray_batch(self, origins, directions, max_length=np.inf):
+        """Cast many rays against the loaded surfaces at once (see cast_rays).
+
+        Returns (files, hit, entry, exit) where the N x M arrays follow the order of files. Entry is 0 for
+        a ray starting inside a surface and exit is max_length for a ray ending inside it.
+        """
+        files = []
+        meshes = []
+        for actor in self.surface_actors:
+            poly_data = self.actor_meshes[actor]
+            cached = self.ray_cast_meshes.get(actor)
+            if cached is None or cached[0] is not poly_data or cached[1] != poly_data.GetMTime():
+                cached = (poly_data, poly_data.GetMTime(), RayCastMesh(poly_data))
+                self.ray_cast_meshes[actor] = cached
+            files.append(self.actor_files[actor])
+            meshes.append(cached[2])
+
+        hit, entry, exit = cast_rays(origins, directions, meshes, max_length=max_length)
+        return files, hit, entry, exit
+
+
+    def get_ray_locator(self, actor, poly_data):
+        """Return the OBB tree of an actor's surface, rebuilt only if the surface has changed."""
+        cached = self.ray_locators.get(actor)
+        if cached is not None:
+            cached_poly_data, build_time, obb_tree = cached
+            if cached_poly_data is poly_data and build_time == poly_data.GetMTime():
+                return obb_tree
+
+        obb_tree = vtk.vtkOBBTree()
+        obb_tree.SetMaxLevel(10)
+        obb_tree.SetDataSet(poly_data)
+        obb_tree.BuildLocator()
+        # Not kept for a structure removed while the query was running
+        if actor in self.actor_files:
+            self.ray_locators[actor] = (poly_data, poly_data.GetMTime(), obb_tree)
+        return obb_tree
+
+
+    def highlight_intersected_files(self, intersected_files, details=None):
+        """Highlight the intersected files in the file list widget, with optional details next to their name."""
+        details = details or {}
+        intersected_files = set(intersected_files)
         for i in range(self.file_list_widget.count()):
             item = self.file_list_widget.item(i)
-            item_name = item.text()
-            intersected_base_names = [
-                os.path.splitext(os.path.basename(file_path))[0] for file_path in intersected_files
-            ]
-            if item_name in intersected_base_names:
+            # The list is populated in the order of nifti_files
+            file_path = self.nifti_files[i]
+            base_name = os.path.splitext(os.path.basename(file_path))[0]
+            item.setText(f"{base_name} ({details[file_path]})" if file_path in details else base_name)
+            if file_path in intersected_files:
                 # Highlight intersected files (red bold text)
                 font = QFont()
                 font.setBold(True)
@@ -667,22 +3055,14 @@ class RenderWindow(QWidget):
                 item.setForeground(Qt.black)
 
 
-    def add_intersection_marker(self, point,radius):
-        """Add a marker to visualize intersection points."""
-        sphere_source = vtk.vtkSphereSource()
-        sphere_source.SetCenter(point)
-        sphere_source.SetRadius(radius) 
-
-        mapper = vtk.vtkPolyDataMapper()
-        mapper.SetInputConnection(sphere_source.GetOutputPort())
-
-        actor = vtk.vtkActor()
-        actor.SetMapper(mapper)
-        actor.GetProperty().SetColor(0.0, 1.0, 0.0)  # Green marker
-
-        # Add marker actor and store it in the list
-        self.vtk_renderer.AddActor(actor)
-        self.intersection_markers.append(actor)
+    def set_intersection_markers(self, points):
+        """Show a marker at each of the given intersection points (replacing the previous ones)."""
+        self.intersection_points = list(points)
+        self.marker_points.Reset()
+        for point in self.intersection_points:
+            self.marker_points.InsertNextPoint(point)
+        self.marker_points.Modified()
+        self.marker_glyph.SetScaleFactor(self.marker_radius)
 
 ###################   UPDATE SLIDDERS VALUES WHEN MOVED    ########################
 
@@ -691,36 +3071,36 @@ class RenderWindow(QWidget):
         if self.ray_origin is None:
             return
         self.ray_origin = (value, self.ray_origin[1], self.ray_origin[2])
-        self.x_label.setText(f"X: {value}") 
-        self.create_ray()
+        self.set_label_text(self.x_label, f"X: {value}")
+        self.request_ray_update()
 
     def on_y_changed(self, value):
         """Update the Y coordinate of the ray."""
         if self.ray_origin is None:
             return
         self.ray_origin = (self.ray_origin[0], value, self.ray_origin[2])
-        self.y_label.setText(f"Y: {value}") 
-        self.create_ray()
+        self.set_label_text(self.y_label, f"Y: {value}")
+        self.request_ray_update()
 
     def on_z_changed(self, value):
         """Update the Z coordinate of the ray."""
         if self.ray_origin is None:
             return
         self.ray_origin = (self.ray_origin[0], self.ray_origin[1], value)
-        self.z_label.setText(f"Z: {value}")  
-        self.create_ray()
+        self.set_label_text(self.z_label, f"Z: {value}")
+        self.request_ray_update()
 
     def on_radius_changed(self, value):
         """Update the radius value when slidder is moved."""
         self.marker_radius = value
-        self.radius_label.setText(f"Radius : {self.marker_radius}")
-        self.create_ray()
+        self.set_label_text(self.radius_label, f"Radius : {self.marker_radius}")
+        self.request_ray_update()
 
     def on_length_changed(self, value):
         """Update the length of the ray."""
         self.ray_length = value
-        self.length_label.setText(f"Length: {value}") 
-        self.create_ray()
+        self.set_label_text(self.length_label, f"Length: {value}")
+        self.request_ray_update()
 
     def on_azimuth_changed(self, value):
         """Update the Azimuth angle of the ray."""
@@ -731,8 +3111,8 @@ class RenderWindow(QWidget):
         # Adjust the ray direction based on the azimuth angle (around Z-axis)
         self.ray_direction = (math.cos(azimuth_rad), math.sin(azimuth_rad), self.ray_direction[2])
         # Update Azimuth label
-        self.azimuth_label.setText(f"Azimuth: {value}°")
-        self.create_ray()
+        self.set_label_text(self.azimuth_label, f"Azimuth: {value}°")
+        self.request_ray_update()
 
 
     def on_elevation_changed(self, value):
@@ -744,8 +3124,55 @@ class RenderWindow(QWidget):
         # Adjust the ray direction based on the elevation angle
         self.ray_direction = (self.ray_direction[0], self.ray_direction[1], math.sin(elevation_rad))
         # Update Elevation label
-        self.elevation_label.setText(f"Elevation: {value}°")
-        self.create_ray()
+        self.set_label_text(self.elevation_label, f"Elevation: {value}°")
+        self.request_ray_update()
+
+
+
+####################### RENDER SCHEDULING #####################
+
+
+    def schedule_frame(self):
+        """Make sure a frame flush is scheduled."""
+        if not self.frame_timer.isActive():
+            self.frame_timer.start()
+
+    def request_render(self):
+        """Mark the scene as dirty, it is rendered once on the next frame."""
+        self.render_pending = True
+        self.schedule_frame()
+
+    def request_ray_update(self):
+        """Recompute the ray and its intersections once on the next frame."""
+        self.ray_update_pending = True
+        self.schedule_frame()
+
+    def set_label_text(self, label, text):
+        """Set the text of a label on the next frame, only the latest text is applied."""
+        self.pending_label_texts[label] = text
+        self.schedule_frame()
+
+    def flush_frame(self):
+        """Apply the pending ray, label and camera updates, then render the scene once."""
+        if self.ray_update_pending:
+            self.ray_update_pending = False
+            self.create_ray()
+
+        for label, text in self.pending_label_texts.items():
+            label.setText(text)
+        self.pending_label_texts.clear()
+
+        if self.camera_labels_pending:
+            self.camera_labels_pending = False
+            self.update_camera_position()
+
+        # A hidden window (back to the file selection) is rendered again when it is shown
+        if self.render_pending and self.isVisible():
+            self.render_pending = False
+            self.vtk_widget.GetRenderWindow().Render()
+
+        # Updates requested while flushing are already handled by this frame
+        self.frame_timer.stop()
 
 
 
@@ -758,7 +3185,7 @@ class RenderWindow(QWidget):
         camera.SetPosition(self.default_view_position)
         camera.SetFocalPoint(self.default_view_focal_point)
         camera.SetViewUp(self.default_view_up)
-        self.vtk_widget.GetRenderWindow().Render()
+        self.request_render()
 
 
     def go_back(self):
@@ -793,7 +3220,6 @@ class RenderWindow(QWidget):
             
             # Apply dimensions to rendering window
             self.vtk_widget.GetRenderWindow().SetSize(vtk_width, vtk_height)
-            self.vtk_widget.GetRenderWindow().Render() 
         else:
             self.is_full_screen = True
             self.setWindowTitle("Render Window (Full Screen)") 
@@ -803,9 +3229,8 @@ class RenderWindow(QWidget):
             vtk_width = self.vtk_widget.width()
             vtk_height = self.vtk_widget.height()
             self.vtk_widget.GetRenderWindow().SetSize(vtk_width, vtk_height)
-            self.vtk_widget.GetRenderWindow().Render()  
 
-        self.vtk_widget.GetRenderWindow().Render()
+        self.request_render()
 
 
     def setup_key_event(self):
@@ -819,27 +3244,60 @@ class RenderWindow(QWidget):
         if key == "f":  
             self.toggle_full_screen()
 
-    def get_center_of_brain(self):
-        """Calculate the center of the bounding box for the first NIfTI file."""
-        reader = vtk.vtkNIFTIImageReader()
-        reader.SetFileName(self.nifti_files[0])
-        reader.Update()
+    def set_lod_level(self, level):
+        """Draw every surface and volume with the given level of detail (0 is full resolution, capped per prop)."""
+        if level == self.lod_level:
+            return
+        self.lod_level = level
+        if self.composite_surfaces is not None:
+            self.composite_surfaces.set_level(level)
+        for actor, mappers in self.lod_mappers.items():
+            actor.SetMapper(mappers[min(level, len(mappers) - 1)])
+
 
-        image_data = reader.GetOutput()
-        bounds = image_data.GetBounds()
+    def on_interaction_start(self, caller=None, event=None):
+        """Switch to the interactive level of detail while the camera moves."""
+        self.interacting = True
+        self.set_lod_level(self.interactive_lod_level)
 
-        # Calculate the center of the bounding box
-        center_x = (bounds[0] + bounds[1]) / 2
-        center_y = (bounds[2] + bounds[3]) / 2
-        center_z = (bounds[4] + bounds[5]) / 2
 
-        return (center_x, center_y, center_z)
+    def on_interaction_end(self, caller=None, event=None):
+        """Go back to full resolution once the camera stops."""
+        self.interacting = False
+        self.set_lod_level(0)
+        self.request_render()
+
+
+    def on_interactive_frame(self, caller=None, event=None):
+        """Adapt the level of detail of the next interactive frames to the target frame rate."""
+        if not self.interacting:
+            return
+        frame_time = self.vtk_renderer.GetLastRenderTimeInSeconds()
+        target_time = 1.0 / LOD_SETTINGS["target_fps"]
+        level_count = 1 + len(LOD_SETTINGS["reductions"])
+        if frame_time > target_time and self.interactive_lod_level < level_count - 1:
+            self.interactive_lod_level += 1
+        elif frame_time < target_time / 4 and self.interactive_lod_level > 0:
+            self.interactive_lod_level -= 1
+        self.set_lod_level(self.interactive_lod_level)
+
+
+    def get_center_of_brain(self):
+        """Calculate the center of the bounding box for the first NIfTI file."""
+        # Served from the header index, no voxel data is decoded
+        return nifti_metadata.get_center(self.nifti_files[0])
 
 
     def observe_camera(self):
         """Set up an observer on the camera to update UI in real time."""
         camera = self.vtk_renderer.GetActiveCamera()
-        camera.AddObserver('ModifiedEvent', self.update_camera_position)
+        camera.AddObserver('ModifiedEvent', self.on_camera_modified)
+
+
+    def on_camera_modified(self, caller=None, event=None):
+        """Refresh the camera labels on the next frame instead of on every camera change."""
+        self.camera_labels_pending = True
+        self.schedule_frame()
 
 
     def truncate_coordinates(self,coords, decimals=2):
@@ -863,22 +3321,155 @@ class RenderWindow(QWidget):
 
     def get_bounds_from_first_nifti(self):
         """Get bounds from the first NIfTI file for cube axes."""
-        reader = vtk.vtkNIFTIImageReader()
-        reader.SetFileName(self.nifti_files[0])
-        reader.Update()
-        image_data = reader.GetOutput()
-        return image_data.GetBounds()
+        return nifti_metadata.get_bounds(self.nifti_files[0])
+
+
+    def get_selection_bounds(self):
+        """Get the bounds enclosing all the selected NIfTI files (from the header index)."""
+        bounds = np.array([nifti_metadata.get_bounds(nifti_file) for nifti_file in self.nifti_files])
+        return tuple(float(value) for value in np.ravel([bounds[:, 0::2].min(axis=0), bounds[:, 1::2].max(axis=0)], "F"))
+
+
+    def update_selection_bounds(self):
+        """Fit the cube axes, the ray origin sliders and the default focal point to the selected files.
+
+        The camera itself is left where it is.
+        """
+        bounds = self.get_selection_bounds()
+        self.cube_axes.SetBounds(bounds)
+        for axis, slider_group in enumerate((self.x_slider, self.y_slider, self.z_slider)):
+            slider_group.findChild(QSlider).setRange(int(bounds[2 * axis]), int(bounds[2 * axis + 1]))
+        self.default_view_focal_point = (
+            (bounds[0] + bounds[1]) / 2,
+            (bounds[2] + bounds[3]) / 2,
+            (bounds[4] + bounds[5]) / 2,
+        )
 
         
-    def create_volume_actor(self, nifti_file):
+    def build_volume_actors(self):
+        """Build the volume actors of the loaded structures that are missing.
+
+        Per file volumes still in memory are reused, those of hidden structures are built when they are shown.
+        """
+        loaded_files = [self.actor_files[actor] for actor in self.surface_actors]
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            if VOLUME_SETTINGS["mode"] == "combined" and share_same_grid(loaded_files):
+                self.release_volume_actors(list(self.volume_budget.entries))
+                # One label volume and one mapper for all structures, colored like their surfaces
+                colors = []
+                opacities = []
+                for actor in self.surface_actors:
+                    colors.append(actor.GetProperty().GetDiffuseColor())
+                    opacity = actor.GetProperty().GetOpacity() if actor.GetVisibility() else 0.0
+                    opacities.append(VOLUME_SETTINGS["opacity"] * opacity)
+                # Only the bounding box of the structures is uploaded to the GPU
+                label_image = create_combined_label_image(self.get_voxel_masks(loaded_files))
+                if label_image is not None:
+                    volume_actor = create_label_volume_actor(label_image, colors, opacities)
+                    self.add_volume_actor(volume_actor)
+                    self.volume_actors = [volume_actor]
+                    # Hover and click look the structure up in the label map
+                    self.volume_label_map = LabelMap(label_image)
+                    self.volume_label_actors = list(self.surface_actors)
+            else:
+                # The combined volume, if any, does not apply anymore
+                self.release_volume_actors(
+                    [volume_actor for volume_actor in self.volume_budget.entries
+                     if volume_actor not in self.volume_structures]
+                )
+                # Each volume only covers the bounding box of its structure, expanded from its voxel mask
+                missing = [
+                    actor for actor in self.surface_actors
+                    if actor.GetVisibility() and actor not in self.structure_volumes
+                ]
+                voxel_masks = self.get_voxel_masks([self.actor_files[actor] for actor in missing])
+                for actor, voxel_mask in zip(missing, voxel_masks):
+                    if voxel_mask is None:
+                        continue  # Empty structure, nothing to draw
+                    volume_actor = self.create_volume_actor(self.actor_files[actor], voxel_mask.to_image_data())
+                    self.volume_structures[volume_actor] = actor
+                    self.structure_volumes[actor] = volume_actor
+                    self.actor_labels[volume_actor] = self.actor_labels[actor]
+                    self.picker.AddPickList(volume_actor)
+                    self.add_volume_actor(volume_actor)
+                self.volume_actors = [
+                    self.structure_volumes[actor] for actor in self.surface_actors if actor in self.structure_volumes
+                ]
+        finally:
+            QApplication.restoreOverrideCursor()
+        self.volume_actors_stale = False
+
+    def add_volume_actor(self, volume_actor):
+        """Give a new volume its downsampled copy drawn while the camera moves, and count it in the budget."""
+        full_mapper = volume_actor.GetMapper()
+        low_mapper = create_volume_mapper(
+            downsample_volume(full_mapper.GetInput(), VOLUME_SETTINGS["interactive_shrink"])
+        )
+        self.lod_mappers[volume_actor] = [full_mapper, low_mapper]
+        volume_actor.SetMapper(self.lod_mappers[volume_actor][min(self.lod_level, 1)])
+        self.volume_budget.add(volume_actor, data_nbytes(full_mapper.GetInput()) + data_nbytes(low_mapper.GetInput()))
+
+    def release_volume_actors(self, volume_actors):
+        """Remove volumes from the scene and free their images and textures."""
+        render_window = self.vtk_widget.GetRenderWindow()
+        for volume_actor in volume_actors:
+            self.vtk_renderer.RemoveActor(volume_actor)
+            for mapper in self.lod_mappers.pop(volume_actor, []):
+                mapper.ReleaseGraphicsResources(render_window)
+            self.picker.DeletePickList(volume_actor)
+            self.actor_labels.pop(volume_actor, None)
+            self.volume_budget.discard(volume_actor)
+            self.uploaded_volumes.discard(volume_actor)
+            if volume_actor in self.volume_structures:
+                del self.structure_volumes[self.volume_structures.pop(volume_actor)]
+            else:
+                self.volume_label_map = None
+                self.volume_label_actors = []
+            if volume_actor in self.volume_actors:
+                self.volume_actors.remove(volume_actor)
+            # Rebuilt the next time volumes are shown
+            self.volume_actors_stale = True
+
+    def enforce_volume_budget(self):
+        """Release the least recently shown volumes that are not on screen until the volumes fit in the budget."""
+        on_screen = set()
+        if self.is_volume_rendering:
+            on_screen = {volume_actor for volume_actor in self.volume_actors if volume_actor.GetVisibility()}
+        self.release_volume_actors(self.volume_budget.over_budget(keep=on_screen))
+        self.update_memory_readout()
+
+    def update_memory_readout(self):
+        """Show the memory held by the images, the surface meshes and the GPU textures of the volumes."""
+        voxel_masks = [voxel_mask for voxel_mask in list(self.voxel_masks.values()) if voxel_mask is not None]
+        image_bytes = self.volume_budget.total() + sum(voxel_mask.nbytes() for voxel_mask in voxel_masks)
+        mesh_bytes = sum(self.mesh_bytes.values())
+        texture_bytes = sum(self.volume_budget.entries.get(volume_actor, 0) for volume_actor in self.uploaded_volumes)
+        self.set_label_text(
+            self.memory_label,
+            f"Memory: images {image_bytes / 2**20:.1f} MB, meshes {mesh_bytes / 2**20:.1f} MB, "
+            f"GPU textures {texture_bytes / 2**20:.1f} MB",
+        )
+
+    def show_volume_actors(self):
+        """Show the volume actors, building first the ones that are missing or outdated."""
+        if self.volume_actors_stale:
+            for volume_actor in self.volume_actors:
+                self.vtk_renderer.RemoveActor(volume_actor)
+            self.build_volume_actors()
+        for volume_actor in self.volume_actors:
+            self.vtk_renderer.AddActor(volume_actor)
+            self.volume_budget.touch(volume_actor)
+            self.uploaded_volumes.add(volume_actor)
+        self.enforce_volume_budget()
+
+    def create_volume_actor(self, nifti_file, image_data=None):
         """Create and return a volume actor with a random color for each NIfTI file."""
-        reader = vtk.vtkNIFTIImageReader()
-        reader.SetFileName(nifti_file)
-        reader.Update()
+        if image_data is None:
+            image_data = read_nifti_image(nifti_file)
 
         # Volume mapper
-        volume_mapper = vtk.vtkGPUVolumeRayCastMapper()
-        volume_mapper.SetInputConnection(reader.GetOutputPort())
+        volume_mapper = create_volume_mapper(image_data)
 
         # Volume color transfer function
         color_func = vtk.vtkColorTransferFunction()
@@ -915,38 +3506,79 @@ class RenderWindow(QWidget):
         self.is_volume_rendering = not self.is_volume_rendering
 
         if self.is_volume_rendering:
-            for actor in self.surface_actors:
+            for actor in self.surface_props():
                 self.vtk_renderer.RemoveActor(actor)
-            for volume_actor in self.volume_actors:
-                self.vtk_renderer.AddActor(volume_actor)
+            self.show_volume_actors()
             self.volume_button.setText("Rendu Surface")
         else:
             for volume_actor in self.volume_actors:
                 self.vtk_renderer.RemoveActor(volume_actor)
-            for actor, label in self.labels:
+            for actor in self.surface_props():
                 self.vtk_renderer.AddActor(actor)
             self.volume_button.setText("Rendu Volume")
+            # The volumes are kept for the next toggle as long as they fit in the budget
+            self.enforce_volume_budget()
+
+        self.request_render()
+
+
+    def surface_props(self):
+        """Return the props drawing the surfaces: the composite actor, or the surface actors."""
+        if self.composite_surfaces is not None:
+            return [self.composite_surfaces.actor]
+        return list(self.surface_actors)
+
+
+    def set_organ_opacity(self, actor, opacity):
+        """Set the opacity of a structure's surface, and of its label in the combined volume."""
+        actor.GetProperty().SetOpacity(opacity)
+        if self.composite_surfaces is not None:
+            self.composite_surfaces.update(actor)
+        self.update_volume_label(actor)
+        self.request_render()
+
+
+    def set_organ_visibility(self, actor, visible):
+        """Show or hide a structure's surface and its per file volume."""
+        actor.SetVisibility(visible)
+        if self.composite_surfaces is not None:
+            self.composite_surfaces.update(actor)
+        if actor in self.structure_volumes:
+            self.structure_volumes[actor].SetVisibility(visible)
+        self.update_volume_label(actor)
+        if self.is_volume_rendering and self.volume_label_map is None:
+            if visible and actor not in self.structure_volumes:
+                # Its volume was never built or was released, build it again
+                self.volume_actors_stale = True
+                self.show_volume_actors()
+            else:
+                self.enforce_volume_budget()
+        self.request_render()
 
-        self.vtk_widget.GetRenderWindow().Render()
+
+    def update_volume_label(self, actor):
+        """Draw a structure's label in the combined volume with the color, opacity and visibility of its surface."""
+        if self.volume_label_map is None or actor not in self.volume_label_actors:
+            return
+        opacity = actor.GetProperty().GetOpacity() if actor.GetVisibility() else 0.0
+        set_label_appearance(
+            self.volume_actors[0], self.volume_label_actors.index(actor) + 1,
+            actor.GetProperty().GetDiffuseColor(), VOLUME_SETTINGS["opacity"] * opacity,
+        )
 
 
     def setup_mouse_move(self):
         """Set up mouse move interactor for showing tooltips."""
         def on_mouse_move(interactor, event):
             x, y = interactor.GetEventPosition()
-            picker = vtk.vtkPropPicker()
-            picker.Pick(x, y, 0, self.vtk_renderer)
-            actor = picker.GetActor()
-
-            if actor:
-                for act, label in self.labels:
-                    if act == actor:
-                        self.text_actor.SetInput(f"Survol: {label}")
-                        break
-            else:
-                self.text_actor.SetInput("")
+            actor = self.pick_structure(x, y)
+            label = self.actor_labels.get(actor)
 
-            interactor.GetRenderWindow().Render()
+            # Only redraw when the hovered structure changes
+            if label != self.hovered_label:
+                self.hovered_label = label
+                self.text_actor.SetInput(f"Survol: {label}" if label else "")
+                self.request_render()
 
         # Get the interactor and attach the event
         interactor = self.vtk_widget
@@ -959,18 +3591,40 @@ class RenderWindow(QWidget):
     def on_left_click(self, interactor, event):
         """Handle left mouse click to open popup for organ controls."""
         x, y = interactor.GetEventPosition()
-        picker = vtk.vtkPropPicker()
-        picker.Pick(x, y, 0, self.vtk_renderer)
-        actor = picker.GetActor()
-
-        if actor:
-            # Find the corresponding label for the clicked actor
-            for act, label in self.labels:
-                if act == actor:
-                    self.show_popup(actor, label)
-                    break
+        actor = self.pick_structure(x, y)
+        if actor in self.volume_structures:
+            # A volume of the per file mode controls its structure's surface
+            actor = self.volume_structures[actor]
+
+        if actor in self.actor_labels:
+            self.show_popup(actor, self.actor_labels[actor])
+            self.request_render()
+
+
+    def pick_structure(self, x, y):
+        """Return the surface or volume actor of the structure at the display position (None if there is none)."""
+        if self.is_volume_rendering and self.volume_label_map is not None:
+            # Combined volume: first labelled voxel along the view ray
+            label = self.volume_label_map.first_label(
+                self.display_to_world(x, y, 0.0), self.display_to_world(x, y, 1.0)
+            )
+            return self.volume_label_actors[label - 1] if label else None
 
-        interactor.GetRenderWindow().Render()
+        if self.composite_surfaces is not None and not self.is_volume_rendering:
+            # Composite actor: the picked block gives the structure
+            return self.composite_surfaces.pick(self.vtk_renderer, x, y)
+
+        if self.picker.Pick(x, y, 0, self.vtk_renderer):
+            return self.picker.GetViewProp()
+        return None
+
+
+    def display_to_world(self, x, y, depth):
+        """Return the world point at a display position and normalized depth (0 near, 1 far plane)."""
+        self.vtk_renderer.SetDisplayPoint(x, y, depth)
+        self.vtk_renderer.DisplayToWorld()
+        world = self.vtk_renderer.GetWorldPoint()
+        return np.array(world[:3]) / world[3]
 
 
     def show_popup(self, actor, label):
@@ -980,11 +3634,11 @@ class RenderWindow(QWidget):
 
 
     def go_back(self):
-        """Return to the file selection screen."""
-        folder_path = os.path.dirname(self.nifti_files[0])  # Extract the folder path from the first file
-        self.main_window = MainWindow(folder_path)  # Pass the folder path
+        """Return to the file selection screen, the window is hidden and reused for the next selection."""
+        folder_path = self.cohort_root or os.path.dirname(self.nifti_files[0])
+        self.main_window = MainWindow(folder_path, render_window=self)
         self.main_window.show()
-        self.close()
+        self.hide()
 
 
 
@@ -994,6 +3648,7 @@ class OrganControlDialog(QDialog):
     
     def __init__(self, parent, actor, label):
         super().__init__(parent)
+        self.render_window = parent
         self.actor = actor
         self.label = label
         self.setWindowTitle(f"Controls for {label}")
@@ -1006,13 +3661,13 @@ class OrganControlDialog(QDialog):
         self.opacity_slider = QSlider()
         self.opacity_slider.setOrientation(Qt.Horizontal)
         self.opacity_slider.setRange(0, 100)
-        self.opacity_slider.setValue(100)
+        self.opacity_slider.setValue(int(round(actor.GetProperty().GetOpacity() * 100)))
         self.opacity_slider.valueChanged.connect(self.update_opacity)
         layout.addRow("Opacity:", self.opacity_slider)
 
         # Add checkbox for visibility toggle
         self.visibility_checkbox = QCheckBox("Toggle")
-        self.visibility_checkbox.setChecked(True)
+        self.visibility_checkbox.setChecked(bool(actor.GetVisibility()))
         self.visibility_checkbox.toggled.connect(self.toggle_visibility)
         layout.addRow("Visible:", self.visibility_checkbox)
 
@@ -1029,13 +3684,13 @@ class OrganControlDialog(QDialog):
     def update_opacity(self):
         """Update the opacity of the organ."""
         opacity = self.opacity_slider.value() / 100.0
-        self.actor.GetProperty().SetOpacity(opacity)
+        self.render_window.set_organ_opacity(self.actor, opacity)
 
 
     def toggle_visibility(self):
         """Toggle the visibility of the organ."""
         is_visible = self.visibility_checkbox.isChecked()
-        self.actor.SetVisibility(is_visible)
+        self.render_window.set_organ_visibility(self.actor, is_visible)
 
 
     def apply_changes(self):
@@ -1043,14 +3698,189 @@ class OrganControlDialog(QDialog):
         self.accept() 
 
 
+class HeatMapLabel(QLabel):
+    """Label showing a heat map image, reporting where it is clicked as fractions of its size."""
+
+    clicked = pyqtSignal(float, float)
+
+    def mousePressEvent(self, event):
+        if self.width() > 0 and self.height() > 0:
+            self.clicked.emit(event.x() / self.width(), event.y() / self.height())
+        super().mousePressEvent(event)
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python script.py <path_to_folder_with_nii_files>")
-        sys.exit(1)
 
-    folder = sys.argv[1]
-    app = QApplication(sys.argv)
+class AngleSweepDialog(QDialog):
+    """Dialog sweeping the beam angles on a grid and showing the path lengths as a heat map."""
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.render_window = parent
+        self.sweep = None
+        self.sweep_generation = None
+        self.setWindowTitle("Beam angle sweep")
+        self.setGeometry(300, 300, 420, 560)
+
+        layout = QFormLayout()
+
+        # Angle grid, in degrees
+        self.azimuth_min = self.create_angle_box(-90)
+        self.azimuth_max = self.create_angle_box(90)
+        self.elevation_min = self.create_angle_box(-90)
+        self.elevation_max = self.create_angle_box(90)
+        self.step_box = QSpinBox()
+        self.step_box.setRange(1, 45)
+        self.step_box.setValue(1)
+        azimuth_row = QHBoxLayout()
+        azimuth_row.addWidget(self.azimuth_min)
+        azimuth_row.addWidget(self.azimuth_max)
+        elevation_row = QHBoxLayout()
+        elevation_row.addWidget(self.elevation_min)
+        elevation_row.addWidget(self.elevation_max)
+        layout.addRow("Azimuth range (°):", azimuth_row)
+        layout.addRow("Elevation range (°):", elevation_row)
+        layout.addRow("Step (°):", self.step_box)
+
+        self.run_button = QPushButton("Run sweep")
+        self.run_button.clicked.connect(self.run_sweep)
+        layout.addRow(self.run_button)
+
+        # Structure shown on the heat map, all of them by default
+        self.structure_combo = QComboBox()
+        self.structure_combo.currentIndexChanged.connect(self.update_heat_map)
+        layout.addRow("Structure:", self.structure_combo)
+
+        self.heat_map_label = HeatMapLabel("Run a sweep to see the path length for every angle.")
+        self.heat_map_label.setAlignment(Qt.AlignCenter)
+        self.heat_map_label.setFixedSize(362, 362)
+        self.heat_map_label.clicked.connect(self.on_heat_map_clicked)
+        layout.addRow(self.heat_map_label)
+
+        self.status_label = QLabel("")
+        layout.addRow(self.status_label)
+
+        self.export_button = QPushButton("Export...")
+        self.export_button.setEnabled(False)
+        self.export_button.clicked.connect(self.export_sweep)
+        layout.addRow(self.export_button)
+
+        self.setLayout(layout)
+
+
+    def create_angle_box(self, value):
+        """Create a spin box for an angle bound."""
+        box = QSpinBox()
+        box.setRange(-90, 90)
+        box.setValue(value)
+        return box
+
+
+    def run_sweep(self):
+        """Start the sweep on the angle grid of the dialog."""
+        step = self.step_box.value()
+        azimuths = np.arange(self.azimuth_min.value(), self.azimuth_max.value() + step / 2, step)
+        elevations = np.arange(self.elevation_min.value(), self.elevation_max.value() + step / 2, step)
+        if azimuths.size == 0 or elevations.size == 0:
+            self.status_label.setText("Empty angle range.")
+            return
+        self.sweep_generation = self.render_window.run_angle_sweep(azimuths, elevations)
+        self.status_label.setText(f"Sweeping {azimuths.size * elevations.size} angles...")
+
+
+    def on_sweep_ready(self, generation, sweep):
+        """Show the result of the latest sweep."""
+        if generation != self.sweep_generation or sweep is None:
+            return
+        self.sweep = sweep
+        self.export_button.setEnabled(True)
+
+        self.structure_combo.blockSignals(True)
+        self.structure_combo.clear()
+        self.structure_combo.addItem("All structures (total path length)")
+        for file_name in sweep.files:
+            self.structure_combo.addItem(os.path.splitext(os.path.basename(file_name))[0])
+        self.structure_combo.blockSignals(False)
+
+        safe = np.count_nonzero(~sweep.crossed().any(axis=2))
+        self.status_label.setText(
+            f"{sweep.path_length.shape[0] * sweep.path_length.shape[1]} angles from {sweep.origin}, "
+            f"{safe} cross no structure. Click the map to aim the ray."
+        )
+        self.update_heat_map()
+
+
+    def update_heat_map(self):
+        """Draw the path length of the selected structure, green where the ray crosses nothing."""
+        if self.sweep is None:
+            return
+        index = self.structure_combo.currentIndex()
+        if index <= 0:
+            values = self.sweep.path_length.sum(axis=2)
+        else:
+            values = self.sweep.path_length[:, :, index - 1]
+
+        # Yellow to red with the path length, elevations increasing upwards
+        scaled = values / values.max() if values.max() > 0 else values
+        image = np.empty(values.shape + (3,), dtype=np.uint8)
+        image[..., 0] = 255
+        image[..., 1] = (255 * (1 - scaled)).astype(np.uint8)
+        image[..., 2] = 0
+        image[values == 0] = (0, 160, 0)
+        image = np.ascontiguousarray(image[::-1])
+
+        height, width = values.shape
+        qimage = QImage(image.data, width, height, 3 * width, QImage.Format_RGB888).copy()
+        pixmap = QPixmap.fromImage(qimage).scaled(
+            self.heat_map_label.width(), self.heat_map_label.height(), Qt.IgnoreAspectRatio, Qt.FastTransformation
+        )
+        self.heat_map_label.setPixmap(pixmap)
+
+
+    def on_heat_map_clicked(self, x, y):
+        """Aim the ray at the clicked angle."""
+        if self.sweep is None:
+            return
+        azimuth = self.sweep.azimuths[min(int(x * len(self.sweep.azimuths)), len(self.sweep.azimuths) - 1)]
+        elevation = self.sweep.elevations[::-1][min(int(y * len(self.sweep.elevations)), len(self.sweep.elevations) - 1)]
+        self.render_window.set_ray_angles(azimuth, elevation)
+
+
+    def export_sweep(self):
+        """Save the sweep as a NumPy archive or a CSV file."""
+        filename, _ = QFileDialog.getSaveFileName(
+            self, "Export sweep", "sweep.npz", "NumPy archive (*.npz);;CSV file (*.csv)"
+        )
+        if filename:
+            self.sweep.save(filename)
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Visualise NIFTI structures in 3D.")
+    parser.add_argument("folder", help="path to the folder with the .nii.gz files")
+    parser.add_argument("--surface-engine", choices=SURFACE_ENGINES,
+                        help="surface extraction engine (default: flying_edges, or VISU_SURFACE_ENGINE)")
+    parser.add_argument("--smp-backend",
+                        help="VTK SMP backend, e.g. STDThread, TBB, OpenMP, Sequential (or VISU_SMP_BACKEND)")
+    parser.add_argument("--smp-threads", type=int,
+                        help="number of SMP threads, 0 for one per core (or VISU_SMP_THREADS)")
+    parser.add_argument("--volume-mode", choices=VOLUME_MODES,
+                        help="volume rendering mode (default: combined, or VISU_VOLUME_MODE)")
+    parser.add_argument("--volume-budget", type=float,
+                        help="memory the volumes may hold in MB, 0 for no limit (default: 2048, or VISU_VOLUME_BUDGET_MB)")
+    parser.add_argument("--surface-mode", choices=SURFACE_RENDER_MODES,
+                        help="draw the surfaces with one actor each or one composite actor (default: actors, or VISU_SURFACE_MODE)")
+    parser.add_argument("--target-fps", type=float,
+                        help="frame rate targeted while the camera moves (default: 20, or VISU_TARGET_FPS)")
+    # Unknown arguments are left to Qt
+    args, qt_args = parser.parse_known_args()
+
+    configure_surface_extraction(args.surface_engine, args.smp_backend, args.smp_threads)
+    configure_volume_rendering(args.volume_mode, args.volume_budget)
+    configure_level_of_detail(args.target_fps)
+    configure_surface_rendering(args.surface_mode)
+
+    folder = args.folder
+    app = QApplication(sys.argv[:1] + qt_args)
     main_window = MainWindow(folder)
     main_window.show()
     sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,51 @@
+import threading
+from concurrent.futures import Future
+
+from PyQt5.QtCore import Qt
+
+from VisualisationApp import LatestOnlyWorker
+
+
+class ImmediateExecutor:
+    """Executor running each task on the calling thread, so its future is already done when returned."""
+
+    def submit(self, function, *args):
+        future = Future()
+        future.set_result(function(*args))
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def submit_with_timeout(worker, function, timeout=5.0):
+    """Call worker.submit() on a thread, returning its generation (None if it did not return in time)."""
+    generations = []
+    thread = threading.Thread(target=lambda: generations.append(worker.submit(function)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return generations[0] if generations else None
+
+
+def test_submit_returns_when_the_task_is_already_done():
+    worker = LatestOnlyWorker()
+    worker.executor = ImmediateExecutor()
+    results = []
+    # Direct connections, there is no event loop to deliver queued signals
+    worker.result_ready.connect(lambda generation, result: results.append((generation, result)), Qt.DirectConnection)
+
+    assert submit_with_timeout(worker, lambda is_outdated: "done") == 1
+    assert results == [(1, "done")]
+    # The worker is free again for the next request
+    assert submit_with_timeout(worker, lambda is_outdated: "again") == 2
+    assert results[-1] == (2, "again")
+
+
+def test_submit_noop_on_the_worker_thread():
+    worker = LatestOnlyWorker()
+    done = threading.Event()
+    worker.result_ready.connect(lambda generation, result: done.set(), Qt.DirectConnection)
+
+    assert submit_with_timeout(worker, lambda is_outdated: None) == 1
+    assert done.wait(5.0)
+    worker.shutdown()